@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Script for converting many yomichan dictionaries into OPF/html in one run.
+#
+# The dictionaries are listed in a json manifest together with their own
+# options. All of them share a single pool of worker processes, which run
+# two kinds of tasks:
+#   1. processing a single term bank (the yomi2tab part), the result is
+#      kept in the bank cache of yomi2tab
+#   2. converting a whole dictionary once all of its banks are processed
+#      (the yomi2opf part), which reads the banks back from the cache
+# So one dictionary's json parsing overlaps with another one's html writing,
+# and every interpreter is started (and every module imported) only once.
+# The number of workers is the core limit. A conversion holds the whole
+# dictionary in memory, so conversions are only started while their
+# estimated memory fits into the memory limit. A bank task only holds a
+# single term bank, so bank tasks are not counted against the limit.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+VERSION = '0.1'
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
+import yomi2tab
+import yomi2opf
+from tab2opf import Tab2Opf, TEMPLATES, SHARD_MINIMUMS
+from collation import COLLATIONS
+
+# Options of a dictionary in the manifest and their defaults.
+# output defaults to {output of the batch}/{name}
+DEFAULTS = {
+    'folder': None,
+    'name': None,
+    'output': None,
+    'simplify': False,
+    'source': 'ja',
+    'target': 'ja',
+    'module': None,
+    'collation': 'codepoint',
+    'html': 'pretty',
+    'volumes': 1,
+    'shard_keys': 10000,
+    'shard_bytes': 0,
+}
+
+# Peak memory of a conversion is roughly this many times the size of the
+# json term banks, plus the interpreter itself
+MEMORY_FACTOR = 3
+BASE_MEMORY_MB = 50
+
+
+def read_manifest(manifest_file):
+    # The manifest is either a list of dictionaries or
+    #   {"defaults": {...}, "dictionaries": [...]}
+    # where every dictionary is an object with at least a "folder"
+    # (or just the folder as a string)
+    with open(manifest_file, encoding='utf-8') as f:
+        manifest = json.load(f)
+    defaults = dict(DEFAULTS)
+    if isinstance(manifest, dict):
+        defaults.update(manifest.get('defaults', {}))
+        manifest = manifest.get('dictionaries', [])
+    dictionaries = []
+    for entry in manifest:
+        if isinstance(entry, str):
+            entry = {'folder': entry}
+        unknown = set(entry) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f'Unknown options {", ".join(sorted(unknown))} '
+                             f'in the manifest entry {entry}')
+        options = dict(defaults, **entry)
+        if options['folder'] is None:
+            raise ValueError(f'The manifest entry {entry} has no folder')
+        if options['collation'] not in COLLATIONS:
+            raise ValueError(f'Unknown collation {options["collation"]}')
+        if options['html'] not in TEMPLATES:
+            raise ValueError(f'Unknown html template {options["html"]}')
+        for option, minimum in SHARD_MINIMUMS.items():
+            value = options[option]
+            if not isinstance(value, int) or value < minimum:
+                raise ValueError(f'{option} must be an integer of at least '
+                                 f'{minimum}, not {value!r}')
+        dictionaries.append(options)
+    return dictionaries
+
+
+def bank_size(file_path):
+    # Uncompressed size of a term bank in bytes
+    if isinstance(file_path, yomi2tab.ZipMember):
+        with zipfile.ZipFile(file_path.archive) as archive:
+            return archive.getinfo(file_path.name).file_size
+    return os.path.getsize(file_path)
+
+
+def process_bank(process, file_path):
+    # Task 1: processes a term bank into the bank cache,
+    # only the number of records and the time go back to the scheduler
+    start = time.perf_counter()
+    records = len(process(file_path))
+    return records, time.perf_counter() - start
+
+
+def convert_dictionary(options, cache_dir):
+    # Task 2: converts a dictionary whose banks are all in the cache,
+    # returns the path of the opf and the time
+    start = time.perf_counter()
+    converter = Tab2Opf(output=options['output'], module=options['module'],
+                        source=options['source'], target=options['target'],
+                        cache_dir=cache_dir,
+                        collation=options['collation'], html=options['html'],
+                        volumes=options['volumes'],
+                        shard_keys=options['shard_keys'],
+                        shard_bytes=options['shard_bytes'])
+    opf = yomi2opf.convert_folder(options['folder'], converter,
+                                  name=options['name'],
+                                  simplify=options['simplify'])
+    return opf, time.perf_counter() - start
+
+
+class Build:
+    # A dictionary of the manifest and the state of its build
+    def __init__(self, options, output, cache_dir):
+        self.options = options = dict(options)
+        if options['name'] is None:
+            options['name'] = os.path.splitext(
+                yomi2tab.infer_output_name(options['folder']))[0]
+        if options['output'] is None:
+            options['output'] = os.path.join(output, options['name'])
+        self.name = options['name']
+        # Same function as the one yomi2opf uses, so that the conversion
+        # finds the processed banks in the cache
+        self.process = yomi2tab.BankCache(
+            partial(yomi2tab.process_bank, simplify=options['simplify'],
+                    escape_newlines=False), cache_dir)
+        self.state = 'processing'
+        self.error = None
+        self.processing = 0
+        self.timings = {
+            'name': self.name, 'folder': str(options['folder']),
+            'banks': 0, 'records': 0, 'estimated_memory_mb': None,
+            'process_seconds': 0.0, 'convert_seconds': None,
+            'started': None, 'finished': None, 'opf': None,
+        }
+        # A missing or unreadable folder only fails its own dictionary
+        try:
+            self.banks = yomi2tab.list_term_banks(options['folder'])
+            self.memory_mb = BASE_MEMORY_MB + MEMORY_FACTOR * sum(
+                map(bank_size, self.banks)) / 2 ** 20
+        except (OSError, zipfile.BadZipFile) as e:
+            logging.error(f'{self.name} failed: {e!r}')
+            self.banks, self.memory_mb = [], 0
+            self.pending = deque()
+            self.fail(e)
+            return
+        self.pending = deque(self.banks)
+        self.timings.update(banks=len(self.banks),
+                            estimated_memory_mb=round(self.memory_mb, 1))
+
+    def processed(self):
+        # Whether all of the banks are processed, so it can be converted
+        return self.state == 'processing' and not self.pending \
+            and self.processing == 0
+
+    def fail(self, error):
+        self.state = 'failed'
+        self.error = error
+        self.pending.clear()
+        self.timings['error'] = repr(error)
+
+
+class Scheduler:
+    # Runs the tasks of all the builds on a shared pool of jobs processes.
+    # Conversions come first, as they are the longest tasks and free the
+    # memory of their dictionary when they are done. Conversions are only
+    # started while the memory of the running ones stays under memory_limit
+    # (a conversion always starts when no other one is running)
+    def __init__(self, builds, jobs=1, memory_limit=0, cache_dir=None):
+        self.builds = builds
+        self.jobs = jobs
+        self.memory_limit = memory_limit
+        self.cache_dir = cache_dir
+        self.reserved = 0
+        self.running = {}
+        self.start = time.perf_counter()
+
+    def elapsed(self):
+        return round(time.perf_counter() - self.start, 3)
+
+    def fits(self, build):
+        return (self.memory_limit <= 0 or self.reserved == 0
+                or self.reserved + build.memory_mb <= self.memory_limit)
+
+    def submit(self, executor):
+        # Submits the next task, returns False if there is none right now
+        for build in self.builds:
+            if build.processed() and self.fits(build):
+                build.state = 'converting'
+                if build.timings['started'] is None:
+                    # A dictionary without term banks
+                    build.timings['started'] = self.elapsed()
+                self.reserved += build.memory_mb
+                logging.info(f'Converting {build.name}')
+                future = executor.submit(convert_dictionary, build.options,
+                                         self.cache_dir)
+                self.running[future] = (build, 'convert')
+                return True
+        for build in self.builds:
+            if build.pending:
+                if build.timings['started'] is None:
+                    build.timings['started'] = self.elapsed()
+                    logging.info(f'Processing {build.name} '
+                                 f'({len(build.banks)} term banks)')
+                future = executor.submit(process_bank, build.process,
+                                         build.pending.popleft())
+                build.processing += 1
+                self.running[future] = (build, 'process')
+                return True
+        return False
+
+    def done(self, future):
+        build, task = self.running.pop(future)
+        if task == 'convert':
+            self.reserved -= build.memory_mb
+        else:
+            build.processing -= 1
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f'{build.name} failed: {e!r}')
+            build.fail(e)
+            return
+        if build.state == 'failed':
+            return
+        if task == 'process':
+            records, seconds = result
+            build.timings['records'] += records
+            build.timings['process_seconds'] += seconds
+        else:
+            opf, seconds = result
+            build.state = 'done'
+            build.timings.update(opf=opf, convert_seconds=seconds,
+                                 finished=self.elapsed())
+            logging.info(f'Finished {build.name}: {opf}')
+
+    def run(self):
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                while len(self.running) < self.jobs and self.submit(executor):
+                    pass
+                if not self.running:
+                    break
+                finished, _ = wait(self.running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self.done(future)
+        return [build.timings for build in self.builds]
+
+
+def check_unique(builds):
+    # Two dictionaries with the same name or output would silently overwrite
+    # each other's html files and share their html hashes in the cache,
+    # e.g. the same title twice or two folders without an index.json
+    seen = {}
+    for build in builds:
+        for what, value in (('name', build.name),
+                            ('output', os.path.abspath(build.options['output']))):
+            other = seen.setdefault((what, value), build)
+            if other is not build:
+                raise ValueError(
+                    f'{other.options["folder"]} and {build.options["folder"]} '
+                    f'both have the {what} {value}, give them different '
+                    'names in the manifest')
+
+
+def timing_report(timings):
+    # One line per dictionary
+    lines = []
+    for t in timings:
+        if 'error' in t:
+            lines.append(f'{t["name"]}: FAILED {t["error"]}')
+            continue
+        lines.append(
+            f'{t["name"]}: {t["banks"]} banks, {t["records"]} records, '
+            f'processing {t["process_seconds"]:.1f}s, '
+            f'converting {t["convert_seconds"]:.1f}s, '
+            f'done after {t["finished"]:.1f}s (started at {t["started"]:.1f}s)'
+            f', estimated {t["estimated_memory_mb"]:.0f}MB -> {t["opf"]}')
+    return '\n'.join(lines)
+
+
+def run_batch(dictionaries, output='opf', jobs=1, memory_limit=0,
+              cache_dir=None):
+    # Builds all the dictionaries of a manifest, returns their timings.
+    # Without a cache_dir the processed banks go to a temporary folder
+    with tempfile.TemporaryDirectory() as tmp:
+        if cache_dir is None:
+            cache_dir = tmp
+        os.makedirs(cache_dir, exist_ok=True)
+        builds = [Build(options, output, cache_dir)
+                  for options in dictionaries]
+        check_unique(builds)
+        return Scheduler(builds, jobs, memory_limit, cache_dir).run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=f'Batch [v{VERSION}] Converts all the yomichan '
+        'dictionaries of a manifest into OPF/html dictionaries on a shared '
+        'pool of processes. Made by Oleksii Kyrylchuk',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('manifest',
+                        help='json file with a list of dictionaries, e.g. '
+                        '[{"folder": "daijirin.zip", "simplify": true}, '
+                        '"meikyou/"]. Every dictionary accepts the options '
+                        f'{", ".join(DEFAULTS)}. '
+                        'A {"defaults": {...}, "dictionaries": [...]} object '
+                        'sets the defaults of all the dictionaries.')
+    parser.add_argument('-o', '--output', default='opf',
+                        help='Every dictionary is written to output/name, '
+                        'unless it sets its own output.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (the core limit).')
+    parser.add_argument('--memory-limit', type=int, default=0, metavar='MB',
+                        help='Only convert as many dictionaries at a time as '
+                        'fit into this many megabytes, judging by the size of '
+                        'their term banks. Term banks are processed one per '
+                        'worker and are not counted. 0 for no limit.')
+    parser.add_argument('--cache', default=None, metavar='cache_dir',
+                        help='Keep the processed term banks and the hashes of '
+                        'the html files in this folder, so that a rebuild '
+                        'only redoes what changed. A temporary folder is '
+                        'used by default.')
+    parser.add_argument('--metrics', default=None, metavar='metrics_file',
+                        help='Write the timings of every dictionary to this '
+                        'json file.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show verbose output.')
+    args = parser.parse_args()
+
+    yomi2tab.setup_logging(args.verbose)
+    try:
+        dictionaries = read_manifest(args.manifest)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        timings = run_batch(dictionaries, output=args.output, jobs=args.jobs,
+                            memory_limit=args.memory_limit,
+                            cache_dir=args.cache)
+    except ValueError as e:
+        parser.error(str(e))
+    print(timing_report(timings))
+    if args.metrics is not None:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            json.dump({'argv': sys.argv, 'jobs': args.jobs,
+                       'memory_limit_mb': args.memory_limit,
+                       'dictionaries': timings},
+                      f, indent=2, ensure_ascii=False)
+    if any('error' in t for t in timings):
+        sys.exit(1)
@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for the hot paths of yomi2tab and tab2opf.
+# The micro-benchmarks first check that the new code path gives exactly the
+# same output as the old one and only then time both of them.
+# The stages benchmark generates a synthetic yomichan folder and measures
+# the throughput and the peak memory of every stage of the conversion.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import peak_rss, reset_peak_rss
+
+
+HIRAGANA = [chr(c) for c in range(0x3041, 0x3097)]
+KATAKANA = [chr(c) for c in range(0x30a1, 0x30f7)]
+KANJI = [chr(c) for c in range(0x4e00, 0x4fff)]
+
+
+def randword(rng, alphabet, lo, hi):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(lo, hi)))
+
+
+def timeit(function, repeat):
+    '''
+    Returns the best wall time of repeat runs of function
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Everything reported by the benchmarks, written out with --json
+RESULTS = []
+
+
+def report(name, old, new):
+    print(f'{name}: old {old:.4f}s, new {new:.4f}s, speedup {old / new:.1f}x')
+    RESULTS.append({'benchmark': name, 'old_seconds': old, 'new_seconds': new,
+                    'speedup': old / new})
+
+
+def generate_folder(folder, entries, bank_size=10000, def_length=200,
+                    dash_fraction=0.05, bracket_fraction=0.3, seed=0):
+    '''
+    Write a synthetic yomichan folder: index.json and term_bank_N.json files
+    with the 8-column entries process_folder expects:
+        [word, reading, tags, rules, score, definitions, id, term_tags]
+    def_length is the average number of characters of a definition,
+    dash_fraction is the fraction of ― katakana/kanji headwords and
+    bracket_fraction is the fraction of definitions with a 【 bracket.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump({'title': 'synthetic', 'format': 3, 'revision': 'bench'}, f)
+    for bank, start in enumerate(range(0, entries, bank_size), start=1):
+        rows = []
+        for i in range(start, min(start + bank_size, entries)):
+            if rng.random() < dash_fraction:
+                word = randword(rng, KANJI, 1, 2) + '―' + randword(rng, KANJI, 0, 1)
+                reading = (randword(rng, HIRAGANA, 0, 2)
+                           + randword(rng, KATAKANA, 1, 4)
+                           + randword(rng, HIRAGANA, 0, 2))
+            else:
+                word = randword(rng, KANJI, 1, 3)
+                reading = randword(rng, HIRAGANA, 1, 6)
+            definitions = []
+            for _ in range(rng.randint(1, 3)):
+                header = f'{reading} ―{randword(rng, KATAKANA, 1, 3)}'
+                if rng.random() < bracket_fraction:
+                    header += f'【{word}】'
+                lines = []
+                length = rng.randint(def_length // 2, def_length * 3 // 2)
+                while length > 0:
+                    line = randword(rng, KANJI + HIRAGANA, 10, 60)
+                    lines.append(line)
+                    length -= len(line)
+                definitions.append('\n'.join([header] + lines))
+            rows.append([word, reading, '', '', 0, definitions, i, ''])
+        with open(os.path.join(folder, f'term_bank_{bank}.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False)
+
+
+def bench_katakana(args):
+    '''
+    df.apply(process_katakana_kanji, axis=1) vs process_katakana_kanji_column
+    '''
+    import pandas as pd
+    import yomi2tab
+
+    rng = random.Random(args.seed)
+    rows = []
+    for _ in range(args.entries):
+        if rng.random() < args.dash_fraction:
+            word = randword(rng, KANJI, 1, 2) + '―' + randword(rng, KANJI, 0, 2)
+            # Some malformed rows without katakana to test the fallback
+            reading = (randword(rng, HIRAGANA, 0, 2)
+                       + randword(rng, KATAKANA, 0, 4)
+                       + randword(rng, HIRAGANA, 0, 2))
+        else:
+            word = randword(rng, KANJI, 1, 3)
+            reading = randword(rng, HIRAGANA, 1, 5)
+        rows.append([word, reading, 'def'])
+    df = pd.DataFrame(rows, columns=['word', 'reading', 'def'])
+
+    old = df.copy().apply(yomi2tab.process_katakana_kanji, axis=1)
+    new = yomi2tab.process_katakana_kanji_column(df.copy())
+    assert old.equals(new), 'process_katakana_kanji_column output differs'
+
+    report('katakana',
+           timeit(lambda: df.copy().apply(yomi2tab.process_katakana_kanji,
+                                          axis=1), args.repeat),
+           timeit(lambda: yomi2tab.process_katakana_kanji_column(df.copy()),
+                  args.repeat))
+
+
+def old_transform_simplify(definition_list):
+    '''
+    yomi2tab.transform_simplify before simplify_definition
+    '''
+    new_def = ''
+    for definition in definition_list:
+        defn = definition.split('\n')
+        header = defn[0].split(' ')
+        try:
+            if header[1][0] == '―':
+                header = [header[0]] + header[2:]
+        except:
+            pass
+        defn[0] = ' '.join(header).replace('-', '')
+        new_def += '\n'.join(defn) + '\n'
+    return new_def
+
+
+def old_clean_brackets(definition_list):
+    return [defn.replace('【', ' 【')
+            if len(defn.split(' 【')) == 1
+            else defn
+            for defn in definition_list]
+
+
+# Pieces of the simplify equivalence corpus, the header is everything
+# up to the first newline
+SIMPLIFY_PIECES = [' ', '  ', '―', '―ア', '-', '--', '\n', '【', ' 【', '】',
+                   'あ', 'ア', '辞書', '-x-', '―カ-ナ']
+
+
+def simplify_corpus(rng, entries, def_length):
+    corpus = [[], [''], ['\n'], [' '], [' ―'], ['a ―'], ['a ― b'],
+              ['a  ―b'], ['a ―b c-d\ne-f'], ['―a ―b'], ['a\n ―b']]
+    for _ in range(entries // 2):
+        corpus.append([''.join(rng.choice(SIMPLIFY_PIECES)
+                               for _ in range(rng.randint(0, 12)))
+                       for _ in range(rng.randint(1, 3))])
+    # Long definitions like the ones of generate_folder
+    for _ in range(entries - entries // 2):
+        definitions = []
+        for _ in range(rng.randint(1, 3)):
+            lines = [f'{randword(rng, HIRAGANA, 1, 6)} '
+                     f'―{randword(rng, KATAKANA, 1, 3)}-']
+            length = rng.randint(def_length // 2, def_length * 3 // 2)
+            while length > 0:
+                lines.append(randword(rng, KANJI + HIRAGANA + ['-'], 10, 60))
+                length -= len(lines[-1])
+            definitions.append('\n'.join(lines))
+        corpus.append(definitions)
+    return corpus
+
+
+def bench_simplify(args):
+    '''
+    The old transform_simplify and clean_brackets vs the list-based ones,
+    then process_folder_records with --simplify on a synthetic folder with
+    long definitions, with the old and the new transform_simplify
+    '''
+    import yomi2tab
+
+    corpus = simplify_corpus(random.Random(args.seed), args.entries,
+                             args.def_length)
+    for definitions in corpus:
+        assert old_transform_simplify(definitions) == \
+            yomi2tab.transform_simplify(definitions), \
+            f'transform_simplify differs for {definitions!r}'
+        assert old_clean_brackets(definitions) == \
+            yomi2tab.clean_brackets(definitions), \
+            f'clean_brackets differs for {definitions!r}'
+
+    report('simplify',
+           timeit(lambda: [old_transform_simplify(d) for d in corpus],
+                  args.repeat),
+           timeit(lambda: [yomi2tab.transform_simplify(d) for d in corpus],
+                  args.repeat))
+    report('clean brackets',
+           timeit(lambda: [old_clean_brackets(d) for d in corpus],
+                  args.repeat),
+           timeit(lambda: [yomi2tab.clean_brackets(d) for d in corpus],
+                  args.repeat))
+
+    new_transform = yomi2tab.transform_simplify
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(args.workdir or tmp, 'yomichan')
+        generate_folder(folder, args.entries, bank_size=args.bank_size,
+                        def_length=args.def_length,
+                        dash_fraction=args.dash_fraction,
+                        bracket_fraction=args.bracket_fraction, seed=args.seed)
+
+        def process(transform):
+            def run():
+                yomi2tab.transform_simplify = transform
+                try:
+                    return yomi2tab.process_folder_records(folder, True)
+                finally:
+                    yomi2tab.transform_simplify = new_transform
+            return run
+
+        assert process(old_transform_simplify)() == process(new_transform)()
+        report('simplify (process_folder_records)',
+               timeit(process(old_transform_simplify), args.repeat),
+               timeit(process(new_transform), args.repeat))
+
+
+def old_escapedef(defn):
+    '''
+    The str.replace chain tab2opf.readkey used before escaping.Escaper
+    '''
+    newl = '<br/>\n'
+    tab = '&emsp;'
+    return defn.replace('\\\\', '\\').\
+        replace('"', '\'').\
+        replace('>', '&gt; ').\
+        replace('<', ' &lt;').\
+        replace('（ア）', f'{newl}{tab}（ア）').\
+        replace('（イ）', f'{newl}{tab}（イ）').\
+        replace('（ウ）', f'{newl}{tab}（ウ）').\
+        replace('（エ）', f'{newl}{tab}（エ）').\
+        replace('（オ）', f'{newl}{tab}（オ）').\
+        replace('\\n', newl).\
+        strip()
+
+
+def old_escapekey(key):
+    return key.\
+        replace('"', '\'').\
+        replace('<', '&lt;').\
+        replace('>', '&gt;').\
+        lower().strip()
+
+
+# Pieces that are glued together into the escaping equivalence corpus.
+# Runs of backslashes before an n are the tricky part of the old chain
+ESCAPE_PIECES = ['\\', '\\\\', '\\n', 'n', '"', '\'', '<', '>', '<br/>',
+                 '（ア）', '（イ）', '（ウ）', '（エ）', '（オ）', '（カ）', '（ア',
+                 ' ', '\t', '\n', '&gt;', 'A', 'ア', '辞書', '【', '】']
+
+
+def escape_corpus(rng, entries):
+    corpus = ['', ' ', '\\', '\\n', '\\\\n', '\\\\\\n', '\\\\\\\\n', '\\\\',
+              'a\\\\\\', ' （ア）a（イ）b ', '"<>"', '<（オ）>']
+    for _ in range(entries // 2):
+        corpus.append(''.join(rng.choice(ESCAPE_PIECES)
+                              for _ in range(rng.randint(1, 40))))
+    # Japanese definitions where most of the rules don't match
+    for _ in range(entries - entries // 2):
+        corpus.append(''.join(randword(rng, KANJI, 5, 30)
+                              + rng.choice(ESCAPE_PIECES)
+                              for _ in range(rng.randint(3, 30))))
+    return corpus
+
+
+def bench_escape(args):
+    '''
+    The old str.replace chains vs escaping.Escaper with the default rules
+    '''
+    from escaping import Escaper, DEF_RULES, KEY_RULES
+
+    escapedef = Escaper(DEF_RULES, strip=True)
+    escapekey = Escaper(KEY_RULES, strip=True, lower=True)
+    corpus = escape_corpus(random.Random(args.seed), args.entries)
+    for text in corpus:
+        assert old_escapedef(text) == escapedef(text), \
+            f'definition escaping differs for {text!r}'
+        assert old_escapekey(text) == escapekey(text), \
+            f'key escaping differs for {text!r}'
+
+    report('escape definitions',
+           timeit(lambda: [old_escapedef(t) for t in corpus], args.repeat),
+           timeit(lambda: [escapedef(t) for t in corpus], args.repeat))
+    report('escape keys',
+           timeit(lambda: [old_escapekey(t) for t in corpus], args.repeat),
+           timeit(lambda: [escapekey(t) for t in corpus], args.repeat))
+
+
+def bench_engine(args):
+    '''
+    yomi2tab --engine pandas vs --engine records, with and without simplify.
+    Checks that both engines write exactly the same tab file
+    '''
+    import yomi2tab
+
+    yomi2tab.set_pandas_options()
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(args.workdir or tmp, 'yomichan')
+        generate_folder(folder, args.entries, bank_size=args.bank_size,
+                        def_length=args.def_length,
+                        dash_fraction=args.dash_fraction,
+                        bracket_fraction=args.bracket_fraction, seed=args.seed)
+        for simplify in (False, True):
+            def pandas_engine():
+                out = io.StringIO()
+                yomi2tab.process_folder(folder, simplify).to_csv(
+                    out, header=False, index=False, sep='\t',
+                    columns=['word', 'def'])
+                return out.getvalue()
+
+            def records_engine():
+                out = io.StringIO()
+                yomi2tab.tab_writer(out).writerows(
+                    yomi2tab.process_folder_records(folder, simplify))
+                return out.getvalue()
+
+            assert pandas_engine() == records_engine(), \
+                'The engines write different tab files'
+            report(f'engine (simplify={simplify})',
+                   timeit(pandas_engine, args.repeat),
+                   timeit(records_engine, args.repeat))
+
+
+def bench_collation(args):
+    '''
+    sorted(keys) vs sorted(keys, key=gojuon_key), the sort keys are
+    computed once per key. Also checks that the katakana, hiragana and
+    long vowel spellings of a word end up next to each other, and that
+    gojuon_key gives the same keys as before its shortcut
+    '''
+    from collation import (gojuon_key, PRIMARY, SECONDARY, LONG_VOWEL_MARK,
+                           LONG_VOWELS, SEPARATOR, expandlong)
+
+    def old_gojuon_key(text):
+        # gojuon_key before the shortcut for text with nothing to fold
+        primary = text.translate(PRIMARY)
+        secondary = text.translate(SECONDARY)
+        if LONG_VOWEL_MARK in text:
+            primary = LONG_VOWELS.sub(expandlong, primary)
+            secondary = LONG_VOWELS.sub(expandlong, secondary)
+        return SEPARATOR.join((primary, secondary, text))
+
+    spellings = ['かあど', 'かーど', 'カード', 'がっこう', 'ガッコウ']
+    assert sorted(spellings + ['かいしゃ', 'ガーデン'], key=gojuon_key) == [
+        'ガーデン', 'かあど', 'かーど', 'カード', 'かいしゃ', 'がっこう', 'ガッコウ']
+
+    rng = random.Random(args.seed)
+    keys = []
+    for _ in range(args.entries):
+        kind = rng.random()
+        if kind < 0.4:
+            keys.append(randword(rng, HIRAGANA, 1, 6))
+        elif kind < 0.6:
+            keys.append(randword(rng, KATAKANA + ['ー'], 1, 6))
+        else:
+            keys.append(randword(rng, KANJI, 1, 3))
+    collated = sorted(keys, key=gojuon_key)
+    assert sorted(collated) == sorted(keys)
+    # Every kana alone, after a plain kana and before a long vowel mark
+    kana = [chr(c) for c in range(0x3000, 0x3100)]
+    edges = kana + [f'か{c}' for c in kana] + [f'{c}ー' for c in kana]
+    for text in edges + keys:
+        assert gojuon_key(text) == old_gojuon_key(text), \
+            f'gojuon_key differs for {text!r}'
+    report('collation keys',
+           timeit(lambda: list(map(old_gojuon_key, keys)), args.repeat),
+           timeit(lambda: list(map(gojuon_key, keys)), args.repeat))
+    report('collation', timeit(lambda: sorted(keys), args.repeat),
+           timeit(lambda: sorted(keys, key=gojuon_key), args.repeat))
+    # Only the sort, without computing the sort keys
+    sortkeys = list(map(gojuon_key, keys))
+    report('collation (sort only)', timeit(lambda: sorted(keys), args.repeat),
+           timeit(lambda: sorted(sortkeys), args.repeat))
+
+
+def old_writeshard(fname, groups):
+    '''
+    tab2opf.writeshard before the templates: writekey formatted the
+    indented entry head for every entry and wrote it piece by piece
+    '''
+    from itertools import groupby
+    from tab2opf import (KEYFILE_HEAD, KEYFILE_TAIL, ENTRY_HEAD, ENTRY_TAIL,
+                         keyf)
+
+    to = io.StringIO()
+    to.write(KEYFILE_HEAD)
+    for key, defn in groups:
+        terms = iter(sorted(defn, key=keyf))
+        for term, g in groupby(terms, key=lambda d: d[0]):
+            for thing in g:
+                to.write(ENTRY_HEAD.format(term=term, key=key))
+                to.write(thing[1])
+                to.write(ENTRY_TAIL)
+    to.write(KEYFILE_TAIL)
+    content = to.getvalue().encode('utf-8')
+    with open(fname, 'wb') as f:
+        f.write(content)
+    return len(content)
+
+
+def bench_render(args):
+    '''
+    Writing the html files: the old writekey vs the pretty and the compact
+    templates, in bytes written per second. Checks that the pretty template
+    writes exactly the same files as the old writekey
+    '''
+    import tab2opf
+
+    rng = random.Random(args.seed)
+    groups = []
+    for _ in range(args.entries // 2):
+        key = randword(rng, HIRAGANA, 1, 6)
+        groups.append((key, [[rng.choice([key, randword(rng, KANJI, 1, 3)]),
+                              randword(rng, KANJI, args.def_length // 2,
+                                       args.def_length * 3 // 2),
+                              rng.random() < 0.5]
+                             for _ in range(rng.randint(1, 3))]))
+    groups.sort(key=lambda group: group[0])
+    shards = [groups[i:i + 10000] for i in range(0, len(groups), 10000)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def old():
+            return sum(old_writeshard(os.path.join(tmp, f'old{i}.html'), shard)
+                       for i, shard in enumerate(shards))
+
+        def new(template):
+            return lambda: sum(
+                tab2opf.writeshard(tmp, template, i, shard,
+                                   template=tab2opf.TEMPLATES[template])[1]
+                for i, shard in enumerate(shards))
+
+        written = {'old': old(), 'pretty': new('pretty')(),
+                   'compact': new('compact')()}
+        for i in range(len(shards)):
+            with open(os.path.join(tmp, f'old{i}.html'), 'rb') as f, \
+                    open(os.path.join(tmp, f'pretty{i}.html'), 'rb') as g:
+                assert f.read() == g.read(), 'The pretty html is different'
+
+        old_time = timeit(old, args.repeat)
+        print(f'render: old {written["old"] / old_time / 2 ** 20:.1f} MB/s')
+        for template in ('pretty', 'compact'):
+            new_time = timeit(new(template), args.repeat)
+            report(f'render ({template})', old_time, new_time)
+            print(f'render ({template}): '
+                  f'{written[template] / new_time / 2 ** 20:.1f} MB/s, '
+                  f'{written[template]} bytes '
+                  f'({written[template] / written["old"]:.0%} of old)')
+            RESULTS[-1]['bytes'] = written[template]
+            RESULTS[-1]['old_bytes'] = written['old']
+            RESULTS[-1]['bytes_per_second'] = written[template] / new_time
+
+
+def same_files(first, second):
+    '''
+    Whether two folders have the same files with the same contents
+    '''
+    if sorted(os.listdir(first)) != sorted(os.listdir(second)):
+        return False
+    for fname in os.listdir(first):
+        with open(os.path.join(first, fname), 'rb') as f, \
+                open(os.path.join(second, fname), 'rb') as g:
+            if f.read() != g.read():
+                return False
+    return True
+
+
+class Interrupted(Exception):
+    pass
+
+
+def bench_resume(args):
+    '''
+    tab2opf --resume: a run interrupted halfway and resumed vs a full run.
+    Checks that resuming writes the same files as a fresh run, also when
+    --presorted yes meets an unsorted input and falls back to sorting it
+    '''
+    from tab2opf import Tab2Opf
+
+    rng = random.Random(args.seed)
+    lines = sorted(f'{randword(rng, HIRAGANA, 1, 6)}\t'
+                   f'{randword(rng, KANJI, args.def_length // 2, args.def_length * 3 // 2)}\n'
+                   for _ in range(args.entries))
+    # A single early key at the end, noticed only after most of the
+    # html files of the sorted pass are written
+    lines.append(f'{HIRAGANA[0]}\t{randword(rng, KANJI, 5, 10)}\n')
+
+    class Interrupting(Tab2Opf):
+        def recordshard(self, fname, result):
+            super().recordshard(fname, result)
+            if len(self.shardstats) == self.interrupt_after:
+                raise Interrupted()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tabfile = os.path.join(tmp, 'resume.tab')
+        with open(tabfile, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+        def convert(output, cls=Tab2Opf, **options):
+            converter = cls(output=os.path.join(tmp, output),
+                            shard_keys=1000, **options)
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                converter.convert(tabfile, 'resume')
+            return converter
+
+        convert('fresh')
+        convert('fallback', presorted='yes', resume=True)
+        assert same_files(os.path.join(tmp, 'fresh'),
+                          os.path.join(tmp, 'fallback')), \
+            'Resuming after an unsorted presorted pass changed the output'
+
+        nshards = len(os.listdir(os.path.join(tmp, 'fresh'))) - 1
+        Interrupting.interrupt_after = nshards // 2
+
+        def interrupted():
+            shutil.rmtree(os.path.join(tmp, 'resumed'), ignore_errors=True)
+            try:
+                convert('resumed', Interrupting, resume=True)
+            except Interrupted:
+                pass
+            else:
+                raise AssertionError('The run was not interrupted')
+
+        def resumed():
+            Interrupting.interrupt_after = None
+            try:
+                return convert('resumed', Interrupting, resume=True)
+            finally:
+                Interrupting.interrupt_after = nshards // 2
+
+        interrupted()
+        converter = resumed()
+        assert converter.progress is None and not os.path.exists(
+            os.path.join(tmp, 'resumed', 'resume.progress.jsonl'))
+        assert same_files(os.path.join(tmp, 'fresh'),
+                          os.path.join(tmp, 'resumed')), \
+            'The resumed run wrote different files'
+
+        full = timeit(lambda: convert('fresh'), args.repeat)
+        best = float('inf')
+        for _ in range(args.repeat):
+            interrupted()
+            start = time.perf_counter()
+            resumed()
+            best = min(best, time.perf_counter() - start)
+        report('resume (full run vs finishing half)', full, best)
+
+
+STAGES = ['process_folder', 'process_folder_records', 'stream_folder', 'readkeys', 'writekeys',
+          'writeopf']
+
+
+def run_stage(stage, workdir, simplify):
+    '''
+    Run a single stage on the files in workdir and measure it.
+    Runs in a fresh process and the peak RSS is reset when the timed part
+    starts, so it belongs to this stage (with its input in memory) only.
+    '''
+    import yomi2tab
+    from tab2opf import Tab2Opf
+
+    folder = os.path.join(workdir, 'yomichan')
+    tabfile = os.path.join(workdir, 'synthetic.tab')
+    output = os.path.join(workdir, 'opf')
+    converter = Tab2Opf(output=output)
+    os.makedirs(output, exist_ok=True)
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    if stage == 'process_folder':
+        yomi2tab.set_pandas_options()
+        result = yomi2tab.process_folder(folder, simplify)
+        elapsed = time.perf_counter() - start
+        count = len(result)
+        # The tab file is the input of the tab2opf stages
+        result.to_csv(tabfile, header=False, index=False, sep='\t',
+                      encoding='utf-8', columns=['word', 'def'])
+    elif stage == 'process_folder_records':
+        result = yomi2tab.process_folder_records(folder, simplify)
+        elapsed = time.perf_counter() - start
+        count = len(result)
+        with yomi2tab.open_output(tabfile) as f:
+            yomi2tab.tab_writer(f).writerows(result)
+    elif stage == 'stream_folder':
+        count = yomi2tab.stream_folder(folder, simplify,
+                                       os.path.join(workdir, 'stream.tab'))
+        elapsed = time.perf_counter() - start
+    elif stage == 'readkeys':
+        count = len(converter.readkeys(tabfile))
+        elapsed = time.perf_counter() - start
+    elif stage == 'writekeys':
+        defns = converter.readkeys(tabfile)
+        reset_peak_rss()
+        start = time.perf_counter()
+        converter.writekeys(defns, 'synthetic')
+        elapsed = time.perf_counter() - start
+        count = len(defns)
+    elif stage == 'writeopf':
+        count = len([f for f in os.listdir(output) if f.endswith('.html')])
+        converter.writeopf(count, 'synthetic')
+        elapsed = time.perf_counter() - start
+    return {'stage': stage, 'seconds': elapsed, 'entries': count,
+            'entries_per_sec': count / elapsed if elapsed else None,
+            'peak_rss_mb': peak_rss()}
+
+
+def bench_stages(args):
+    '''
+    Generate a synthetic yomichan folder and run every stage of
+    yomi2tab/tab2opf on it, reporting entries/sec and peak RSS
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        start = time.perf_counter()
+        generate_folder(os.path.join(workdir, 'yomichan'), args.entries,
+                        bank_size=args.bank_size, def_length=args.def_length,
+                        dash_fraction=args.dash_fraction,
+                        bracket_fraction=args.bracket_fraction, seed=args.seed)
+        print(f'Generated {args.entries} entries in '
+              f'{time.perf_counter() - start:.1f}s')
+        spawn = multiprocessing.get_context('spawn')
+        for stage in STAGES:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                try:
+                    result = pool.submit(run_stage, stage, workdir,
+                                         args.simplify).result()
+                except Exception as e:
+                    # e.g. pandas is not installed
+                    result = {'stage': stage, 'error': repr(e)}
+                    print(f'{stage}: failed with {e!r}')
+                else:
+                    print(f'{stage}: {result["seconds"]:.2f}s, '
+                          f'{result["entries_per_sec"]:.0f} entries/s, '
+                          f'peak RSS {result["peak_rss_mb"]} MB')
+            result['benchmark'] = 'stages'
+            RESULTS.append(result)
+
+
+BENCHMARKS = {
+    'katakana': bench_katakana,
+    'escape': bench_escape,
+    'engine': bench_engine,
+    'collation': bench_collation,
+    'render': bench_render,
+    'simplify': bench_simplify,
+    'resume': bench_resume,
+    'stages': bench_stages,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Compares the old and the new implementations of the '
+        'yomi2tab/tab2opf hot paths on synthetic data.')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                        metavar='benchmark',
+                        help=f'Benchmarks to run: {", ".join(BENCHMARKS)}')
+    parser.add_argument('-n', '--entries', type=int, default=100000,
+                        help='Number of synthetic entries')
+    parser.add_argument('--dash-fraction', type=float, default=0.05,
+                        help='Fraction of ― katakana/kanji headwords')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of timing runs, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--bank-size', type=int, default=10000,
+                        help='Number of entries in a synthetic term bank')
+    parser.add_argument('--def-length', type=int, default=200,
+                        help='Average length of a synthetic definition')
+    parser.add_argument('--bracket-fraction', type=float, default=0.3,
+                        help='Fraction of definitions with a 【 bracket')
+    parser.add_argument('-s', '--simplify', action='store_true',
+                        help='Run the yomi2tab stages with --simplify')
+    parser.add_argument('--workdir', default=None,
+                        help='Keep the synthetic files of the stages '
+                        'benchmark in this folder instead of a temporary one')
+    parser.add_argument('--json', default=None, metavar='FILE',
+                        help='Write the results to FILE as json')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+
+    for name in args.benchmarks:
+        BENCHMARKS[name](args)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'arguments': vars(args), 'results': RESULTS}, f,
+                      indent=2)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Japanese collation for yomi2tab and tab2opf.
+#
+# The default order of both scripts is the raw code point order, which puts
+# the katakana and hiragana spellings of a word far apart. The gojuon
+# collation sorts in dictionary (gojūon) order instead:
+#   1. the kana folded to plain hiragana: katakana -> hiragana,
+#      small and voiced kana -> the plain kana, ー -> the vowel before it
+#   2. the same, but keeping the small and voiced kana apart
+#   3. the original string, so different strings never compare equal
+# The three levels are joined into one string per key, so the sort keys are
+# computed once and compared as plain strings.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import re
+import unicodedata
+
+HIRAGANA = range(0x3041, 0x3097)
+# Katakana is the same block, 0x60 code points later
+KATAKANA_OFFSET = 0x60
+# ヷヸヹヺ have no hiragana of their own
+EXTRA_KATAKANA = {'ヷ': 'わ', 'ヸ': 'ゐ', 'ヹ': 'ゑ', 'ヺ': 'を'}
+SMALL_KANA = dict(zip('ぁぃぅぇぉっゃゅょゎゕゖ', 'あいうえおつやゆよわかけ'))
+GOJUON = ['あいうえお', 'かきくけこ', 'さしすせそ', 'たちつてと', 'なにぬねの',
+          'はひふへほ', 'まみむめも', 'や ゆ よ', 'らりるれろ', 'わゐ ゑを']
+LONG_VOWEL_MARK = 'ー'
+
+# Joins the levels of a sort key, it sorts before every other character
+SEPARATOR = '\0'
+
+
+def plainkana(kana):
+    '''
+    The plain hiragana of a hiragana: no dakuten and not small
+    '''
+    kana = unicodedata.normalize('NFD', kana)[0]
+    return SMALL_KANA.get(kana, kana)
+
+
+def maketables():
+    '''
+    Returns the str.translate tables of the first two levels
+    and the vowel of every hiragana
+    '''
+    primary, secondary = {}, {}
+    for code in HIRAGANA:
+        kana = chr(code)
+        for char in (kana, chr(code + KATAKANA_OFFSET)):
+            primary[ord(char)] = plainkana(kana)
+            secondary[ord(char)] = kana
+    for katakana, kana in EXTRA_KATAKANA.items():
+        primary[ord(katakana)] = secondary[ord(katakana)] = kana
+    vowels = {}
+    for code in HIRAGANA:
+        kana = chr(code)
+        for row in GOJUON:
+            if plainkana(kana) in row:
+                vowels[kana] = GOJUON[0][row.index(plainkana(kana))]
+    return primary, secondary, vowels
+
+
+PRIMARY, SECONDARY, VOWELS = maketables()
+LONG_VOWELS = re.compile(f'([{"".join(VOWELS)}]){LONG_VOWEL_MARK}+')
+
+
+def expandlong(match):
+    kana, marks = match.group(1), len(match.group()) - 1
+    return kana + VOWELS[kana] * marks
+
+
+def gojuon_key(text):
+    '''
+    Sort key of text in gojūon order, see the top of the file
+    '''
+    primary = text.translate(PRIMARY)
+    # Nothing to fold (kanji, plain hiragana...): the secondary level only
+    # differs from the text where the primary one does, so it is skipped
+    if primary == text and LONG_VOWEL_MARK not in text:
+        return SEPARATOR.join((text, text, text))
+    secondary = text.translate(SECONDARY)
+    if LONG_VOWEL_MARK in text:
+        primary = LONG_VOWELS.sub(expandlong, primary)
+        secondary = LONG_VOWELS.sub(expandlong, secondary)
+    return SEPARATOR.join((primary, secondary, text))
+
+
+# Sort key functions by name, None sorts by code point
+COLLATIONS = {
+    'codepoint': None,
+    'gojuon': gojuon_key,
+}
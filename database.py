@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# SQLite intermediate format between yomi2tab and tab2opf.
+#
+# The entries are stored as they are, with real newlines and tabs, so
+# nothing has to be escaped on the way in and unescaped on the way out like
+# in a tab file. tab2opf adds a table with the keys it derived and an index
+# on them, which lets it read the entries in key order, or just a range of
+# keys, without loading the whole dictionary.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import pathlib
+import sqlite3
+
+FORMAT_VERSION = '1'
+
+# Written by yomi2tab, the entries keep their order in id
+ENTRIES_SCHEMA = '''
+CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE entries (
+    id INTEGER PRIMARY KEY,
+    word TEXT NOT NULL,
+    definition TEXT NOT NULL
+);
+'''
+
+# Written by tab2opf: the key of every entry, what it is sorted by
+# in the collation of the converter and whether it is the term itself,
+# indexed by sortkey so that any range of keys can be read on its own.
+# The keys depend on the settings of the converter, which are kept in meta
+# as keys, so later runs with the same settings read them as they are.
+# {schema} is main, or work for a temporary database attached with
+# ATTACH_WORK when the database can't be written (e.g. it is read-only),
+# which is deleted when the connection is closed
+KEYS_SCHEMA = '''
+DROP TABLE IF EXISTS {schema}.keys;
+CREATE TABLE {schema}.keys (
+    entry INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    sortkey TEXT NOT NULL,
+    match INTEGER NOT NULL
+);
+'''
+KEYS_INDEX = 'CREATE INDEX {schema}.keys_sortkey ON keys (sortkey, entry)'
+ATTACH_WORK = "ATTACH DATABASE '' AS work"
+
+SQLITE_HEADER = b'SQLite format 3\0'
+
+
+def isdatabase(filename):
+    '''
+    Whether filename is an SQLite database, judging by its header
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def open_database(filename):
+    '''
+    Connects to the existing database filename. A database that can't be
+    written is still opened, only the writes fail
+    '''
+    uri = pathlib.Path(os.path.abspath(filename)).as_uri()
+    return sqlite3.connect(f'{uri}?mode=rw', uri=True)
+
+
+def read_meta(connection, name):
+    '''
+    The value of name in the meta table, None if it isn't there
+    '''
+    row = connection.execute('SELECT value FROM meta WHERE name = ?',
+                             (name,)).fetchone()
+    return None if row is None else row[0]
+
+
+class DatabaseWriter:
+    '''
+    Writes (word, definition) rows into a new database, replacing the file.
+    Has the same writerows as a csv writer, so it can be used instead of one.
+    '''
+
+    def __init__(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(ENTRIES_SCHEMA)
+        self.connection.execute('INSERT INTO meta VALUES (?, ?)',
+                                ('format', FORMAT_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.connection.commit()
+        self.connection.close()
+
+    def writerows(self, rows):
+        self.connection.executemany(
+            'INSERT INTO entries (word, definition) VALUES (?, ?)', rows)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Rule-based string escaping for tab2opf.
+#
+# The rules are declared as data, a list of (old, new) pairs, so that the
+# modules loaded with tab2opf --module can extend them with their own
+# defrules/keyrules lists.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+NEWLINE = '<br/>\n'
+TAB = '&emsp;'
+
+# Rules for the definitions read from a tab file, applied in order
+DEF_RULES = [
+    ('\\\\', '\\'),
+    ('"', '\''),
+    ('>', '&gt; '),
+    ('<', ' &lt;'),
+    ('（ア）', f'{NEWLINE}{TAB}（ア）'),
+    ('（イ）', f'{NEWLINE}{TAB}（イ）'),
+    ('（ウ）', f'{NEWLINE}{TAB}（ウ）'),
+    ('（エ）', f'{NEWLINE}{TAB}（エ）'),
+    ('（オ）', f'{NEWLINE}{TAB}（オ）'),
+    ('\\n', NEWLINE),
+]
+
+# Rules for definitions that never went through a tab file, e.g. the ones
+# yomi2opf passes straight from yomi2tab. They have real newlines and no
+# escaped backslashes. The newline rule has to run before the (ア) rules,
+# otherwise the newlines they add would be replaced again
+RAW_DEF_RULES = [
+    ('"', '\''),
+    ('>', '&gt; '),
+    ('<', ' &lt;'),
+    ('\n', NEWLINE),
+    ('（ア）', f'{NEWLINE}{TAB}（ア）'),
+    ('（イ）', f'{NEWLINE}{TAB}（イ）'),
+    ('（ウ）', f'{NEWLINE}{TAB}（ウ）'),
+    ('（エ）', f'{NEWLINE}{TAB}（エ）'),
+    ('（オ）', f'{NEWLINE}{TAB}（オ）'),
+]
+
+# Rules for the keys and the terms
+KEY_RULES = [
+    ('"', '\''),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+]
+
+
+class Escaper:
+    '''
+    Applies a list of (old, new) rules to a string, in order, then
+    lowercases and strips it if asked to.
+
+    The rules are run as a chain of str.replace calls. A single pass with
+    str.translate or a regex alternation was tried, but on Japanese text
+    it is 2-6 times slower: translate has no fast path for non-ASCII strings,
+    while str.replace doesn't copy the string when there is nothing to replace,
+    which is the case for most rules and most definitions.
+    The loop over the rules costs little against the same chain written out
+    by hand (benchmark.py escape: about 1.0x for the definitions and 0.7x to
+    1.0x for the short keys), which is the price of rules that modules can
+    extend.
+    '''
+
+    def __init__(self, rules, strip=False, lower=False):
+        # Rules that don't change anything are dropped
+        self.rules = tuple((old, new) for old, new in rules if old != new)
+        self.strip = strip
+        self.lower = lower
+
+    def __call__(self, text):
+        for old, new in self.rules:
+            text = text.replace(old, new)
+        if self.lower:
+            text = text.lower()
+        if self.strip:
+            text = text.strip()
+        return text
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Per-stage timing and memory metrics for yomi2tab and tab2opf.
+#
+# Every named stage records its wall time, CPU time, the peak RSS of the
+# process while it ran and the number of records it handled. The report is written as
+# json with --metrics, and --profile dumps a cProfile of the slowest stage
+# that can be opened with pstats or snakeviz.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import cProfile
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss():
+    '''
+    Peak resident memory of this process in megabytes since the last
+    reset_peak_rss, None if unknown
+    '''
+    # VmHWM is the high-water mark of this process alone, unlike ru_maxrss
+    # which also covers the process it was exec'd from
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return rss / 2 ** 20
+    return rss / 2 ** 10
+
+
+def reset_peak_rss():
+    '''
+    Lowers the peak of peak_rss to the current RSS, returns False if the
+    system can't do that (anything but Linux), then the peak only grows
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Metrics:
+    '''
+    Collects the metrics of named stages.
+
+    A stage that runs several times (e.g. once per term bank) is summed up
+    into a single entry. Stages can be nested, the outer stage includes the
+    time and the memory of the inner ones. Only the outermost stages are profiled, as
+    cProfile can't profile nested calls twice.
+    Stages that run in worker processes (--jobs) are not recorded, the
+    outer stage in the main process still covers their wall time.
+    '''
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.stages = {}
+        self.profiles = {}
+        self.depth = 0
+        # The peak RSS of every running stage so far, innermost last, and of
+        # the whole run, as the peak is reset whenever a stage starts
+        self.peaks = []
+        self.peak = None
+        self.start = time.perf_counter()
+
+    def updatepeaks(self):
+        '''
+        Adds the peak RSS since the last reset to the running stages
+        '''
+        peak = peak_rss()
+        if peak is not None:
+            self.peaks = [max(p, peak) for p in self.peaks]
+            self.peak = max(self.peak or 0, peak)
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager that measures the code inside it as the stage name
+        '''
+        stats = self.stages.setdefault(name, {
+            'stage': name, 'calls': 0, 'wall_seconds': 0.0,
+            'cpu_seconds': 0.0, 'records': None, 'peak_rss_mb': None})
+        profiler = None
+        if self.profile and self.depth == 0:
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        self.depth += 1
+        self.updatepeaks()
+        reset_peak_rss()
+        self.peaks.append(peak_rss() or 0)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats['wall_seconds'] += time.perf_counter() - wall
+            stats['cpu_seconds'] += time.process_time() - cpu
+            self.depth -= 1
+            if profiler is not None:
+                profiler.disable()
+            stats['calls'] += 1
+            self.updatepeaks()
+            peak = self.peaks.pop()
+            if peak:
+                stats['peak_rss_mb'] = max(stats['peak_rss_mb'] or 0, peak)
+
+    def count(self, name, records):
+        '''
+        Adds records to the number of records handled by the stage name
+        '''
+        stats = self.stages[name]
+        stats['records'] = (stats['records'] or 0) + records
+
+    def report(self):
+        self.updatepeaks()
+        return {
+            'argv': sys.argv,
+            'wall_seconds': time.perf_counter() - self.start,
+            'cpu_seconds': time.process_time(),
+            'peak_rss_mb': self.peak,
+            'stages': list(self.stages.values()),
+        }
+
+    def slowest(self):
+        '''
+        Name of the slowest profiled stage, None if nothing was profiled
+        '''
+        if not self.profiles:
+            return None
+        return max(self.profiles,
+                   key=lambda name: self.stages[name]['wall_seconds'])
+
+    def write(self, metrics_file=None, profile_file=None):
+        '''
+        Writes the json report to metrics_file and the cProfile
+        of the slowest stage to profile_file
+        '''
+        if metrics_file is not None:
+            report = self.report()
+            report['profiled_stage'] = self.slowest()
+            with open(metrics_file, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        if profile_file is not None and self.slowest() is not None:
+            self.profiles[self.slowest()].dump_stats(profile_file)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Script for building the opf dictionaries written by tab2opf (e.g. the
+# volumes of tab2opf --volumes) with kindlegen, several of them at a time.
+#
+# The compiler command is configurable, {opf} in it is replaced with the
+# path of the opf. --stub replaces kindlegen with a stand-in that only
+# checks that everything the opf references is there and writes an empty
+# .mobi next to it, so the pipeline can be tested without kindlegen.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+VERSION = '0.1'
+
+import argparse
+import glob
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yomi2tab
+
+DEFAULT_COMMAND = 'kindlegen {opf}'
+STUB_COMMAND = f'{shlex.quote(sys.executable)} ' \
+    f'{shlex.quote(os.path.abspath(__file__))} --stub-compile {{opf}}'
+# kindlegen exits with 1 when it built the book but had warnings
+SUCCESS_CODES = [0, 1]
+
+HREF = re.compile(r'<item [^>]*href="([^"]+)"')
+
+
+def list_opfs(paths):
+    # The opf files among paths, a folder stands for all of the opfs in it
+    opfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            opfs.extend(sorted(glob.glob(os.path.join(path, '*.opf'))))
+        else:
+            opfs.append(path)
+    return opfs
+
+
+def compile_opf(command, opf):
+    # Runs the compiler command on a single opf in a worker process,
+    # returns (return code, seconds, output). A compiler that can't be
+    # started (e.g. kindlegen is not installed) is a failure with code None
+    args = [arg.replace('{opf}', opf) for arg in shlex.split(command)]
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(args, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+    except OSError as e:
+        return None, time.perf_counter() - start, str(e)
+    output = process.stdout.decode('utf-8', errors='replace')
+    return process.returncode, time.perf_counter() - start, output
+
+
+def compile_all(opfs, command=DEFAULT_COMMAND, jobs=1,
+                success_codes=SUCCESS_CODES):
+    # Compiles every opf with a pool of jobs processes, the biggest
+    # (by the size of their html files) first so that they don't end up last.
+    # Returns {opf: (return code, seconds, output)}
+    opfs = sorted(opfs, key=opf_size, reverse=True)
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(compile_opf, command, opf): opf
+                   for opf in opfs}
+        for future in as_completed(futures):
+            opf = futures[future]
+            code, seconds, output = results[opf] = future.result()
+            if code in success_codes:
+                logging.info(f'Built {opf} in {seconds:.1f}s')
+            else:
+                logging.error(f'Building {opf} failed with {code}:\n{output}')
+    return results
+
+
+def referenced_files(opf):
+    # Paths of the files in the manifest of an opf
+    with open(opf, encoding='utf-8') as f:
+        hrefs = HREF.findall(f.read())
+    return [os.path.join(os.path.dirname(opf), href) for href in hrefs]
+
+
+def opf_size(opf):
+    return sum(os.path.getsize(f) for f in referenced_files(opf)
+               if os.path.exists(f))
+
+
+def stub_compile(opf):
+    # The --stub compiler: checks the files of the opf, writes an empty .mobi
+    missing = [f for f in referenced_files(opf) if not os.path.exists(f)]
+    if missing:
+        print(f'{opf} references missing files: {", ".join(missing)}')
+        return 2
+    with open(f'{os.path.splitext(opf)[0]}.mobi', 'wb'):
+        pass
+    print(f'{opf}: {len(referenced_files(opf))} files, {opf_size(opf)} bytes')
+    return 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--stub-compile']:
+        sys.exit(stub_compile(sys.argv[2]))
+
+    parser = argparse.ArgumentParser(
+        description=f'Opf2Mobi [v{VERSION}] Builds OPF/html dictionaries '
+        '(e.g. the volumes written by tab2opf --volumes) with kindlegen in '
+        'parallel. Made by Oleksii Kyrylchuk',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('opfs', nargs='+', metavar='opf',
+                        help='opf files, or folders with opf files.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of opfs built at a time.')
+    parser.add_argument('-c', '--command', default=DEFAULT_COMMAND,
+                        help='Compiler command, {opf} is replaced with the '
+                        'path of the opf.')
+    parser.add_argument('--stub', action='store_true',
+                        help='Use a stand-in compiler that only checks the '
+                        'files of every opf and writes an empty .mobi, for '
+                        'testing without kindlegen.')
+    parser.add_argument('--success-codes', type=int, nargs='+',
+                        default=SUCCESS_CODES, metavar='CODE',
+                        help='Return codes of the compiler that mean success.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show verbose output.')
+    args = parser.parse_args()
+
+    yomi2tab.setup_logging(args.verbose)
+    opfs = list_opfs(args.opfs)
+    if not opfs:
+        parser.error('no opf files found')
+    command = STUB_COMMAND if args.stub else args.command
+
+    start = time.perf_counter()
+    results = compile_all(opfs, command, args.jobs, args.success_codes)
+    failed = [opf for opf, (code, _, _) in results.items()
+              if code not in args.success_codes]
+    logging.info(f'Built {len(opfs) - len(failed)} of {len(opfs)} opfs in '
+                 f'{time.perf_counter() - start:.1f}s')
+    if failed:
+        sys.exit(1)
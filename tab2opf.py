@@ -46,36 +46,68 @@ VERSION = "0.2.2"
 import sys
 import os
 import argparse
-from itertools import islice, count, groupby
+import hashlib
+import heapq
+import html
+import json
+import bisect
+import mmap
+import pickle
+import sqlite3
+import tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
 from tqdm import tqdm
 import importlib
+from escaping import Escaper, DEF_RULES, RAW_DEF_RULES, KEY_RULES
+from metrics import Metrics
+from collation import COLLATIONS
+from database import (isdatabase, open_database, read_meta, KEYS_SCHEMA,
+                      KEYS_INDEX, ATTACH_WORK)
 
+# Smallest allowed --shard-keys and --shard-bytes (0 is no limit)
+SHARD_MINIMUMS = {'shard_keys': 1, 'shard_bytes': 0}
 
-def normalizeLetter(ch):
-    # Stop with the encoding -- it's broken anyhow
-    # in the kindles and undefined.
-    try:
-        ch = mapping[ch]
-    except KeyError:
-        pass
-    return ch
 
-
-def normalizeUnicode(text):
+def atleast(minimum):
     '''
-    Reduce some characters to something else
+    argparse type for an int that is at least minimum
     '''
-    return ''.join(normalizeLetter(c) for c in text)
+    def integer(text):
+        value = int(text)
+        if value < minimum:
+            raise argparse.ArgumentTypeError(
+                f'{value} is less than {minimum}')
+        return value
+    return integer
 
 
-def parseargs():
+def parseargs(argv=None):
     # Args:
     #  --verbose
-    #  --module: module to load and attempt to extract getdef, getkey & mapping
+    #  --key-cache: size of the LRU cache for the term -> key derivation
+    #  --presorted: auto/yes/no, whether the input is sorted by key
+    #  --memory-budget: sort unsorted input on disk with this many MB of memory
+    #  --jobs: number of processes writing the html files
+    #  --cache: folder with the hashes of the written html files
+    #  --shard-keys/--shard-bytes: maximum keys/bytes in a single html file
+    #  --storage: mmap/memory, how unsorted input is kept until it is written
+    #  --collation: codepoint/gojuon, the order of the keys and the terms
+    #  --html: pretty/compact, whether the html files are indented
+    #  --volumes: number of opfs the key files are split into by key range
+    #  --resume: skip the html files a killed run already finished
+    #  --metrics: json file with the time and memory of every stage
+    #  --profile: file with a cProfile of the slowest stage
+    #  --module: module to load and attempt to extract getdef, getkey, mapping
+    #            and the extra escaping rules defrules & keyrules
     #  --source: source language code (en by default)
     #  --target: target language code (en by default)
-    #  file: the tab delimited file to read
+    #  file: the tab delimited file (or yomi2tab database) to read
     parser = argparse.ArgumentParser(
         'tab2opf', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description=f'Tab2Opf [v{VERSION}] Converts dictionaries from a '
@@ -89,96 +121,72 @@ def parseargs():
     parser.add_argument('-s', '--source', default='ja', help='Source language')
     parser.add_argument('-t', '--target', default='ja', help='Target language')
     parser.add_argument('-o', '--output', default='opf', help='Target folder')
-    parser.add_argument('file', help='tab file to input')
-    return parser.parse_args()
+    parser.add_argument('--key-cache', type=int, default=2 ** 16,
+                        help='Size of the LRU cache for the key derivation, '
+                        '0 to disable it')
+    parser.add_argument('--presorted', choices=['auto', 'yes', 'no'],
+                        default='auto',
+                        help='Whether the input is sorted by key. Sorted input '
+                        'is written while it is read, so only one key has to '
+                        'be in memory. auto checks the keys first; unsorted '
+                        'input always falls back to the in-memory path')
+    parser.add_argument('--memory-budget', type=int, default=0, metavar='MB',
+                        help='Sort unsorted input on disk, keeping at most '
+                        'about this many megabytes of entries in memory. '
+                        '0 keeps the whole dictionary in memory')
+    parser.add_argument('--storage', choices=['mmap', 'memory'],
+                        default='mmap',
+                        help='How unsorted input is kept until it is written. '
+                        'mmap only keeps the keys and the offsets of the '
+                        'lines and reads the definitions from the '
+                        'memory-mapped file when they are written, memory '
+                        'keeps all of the escaped definitions')
+    parser.add_argument('--collation', choices=sorted(COLLATIONS),
+                        default='codepoint',
+                        help='Order of the keys and of the terms of a key. '
+                        'gojuon sorts in dictionary order, with the katakana '
+                        'and hiragana spellings of a word next to each other')
+    parser.add_argument('--html', choices=sorted(TEMPLATES), default='pretty',
+                        help='pretty indents the html files, compact writes '
+                        'the same markup without the indentation, which '
+                        'makes the files a lot smaller')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to write the html files')
+    parser.add_argument('--cache', default=None, metavar='cache_dir',
+                        help='Keep the hashes of the html files in this '
+                        'folder, so that a rebuild leaves the files whose '
+                        'contents did not change untouched')
+    parser.add_argument('--shard-keys', default=10000,
+                        type=atleast(SHARD_MINIMUMS['shard_keys']),
+                        help='Maximum number of keys in a single html file')
+    parser.add_argument('--shard-bytes', default=0,
+                        type=atleast(SHARD_MINIMUMS['shard_bytes']),
+                        help='Maximum size of a single html file in bytes, '
+                        '0 for no limit')
+    parser.add_argument('--volumes', type=int, default=1,
+                        help='Split the dictionary into this many volumes by '
+                        'key range, each with its own opf and about the same '
+                        'size, so that kindlegen can build them in parallel '
+                        '(see opf2mobi.py)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the html files that a killed run with the '
+                        'same input and settings already finished, see '
+                        '{name}.progress.jsonl in the output folder')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='Write the wall time, CPU time, peak memory and '
+                        'record count of every stage to this json file')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='Write a cProfile of the slowest stage to this file')
+    parser.add_argument('file', help='tab file (or sqlite database written '
+                        'by yomi2tab --format sqlite) to input')
+    return parser.parse_args(argv)
 
 
 def loadmember(mod, attr, dfault):
     if hasattr(mod, attr):
         print(f'Loading {attr} from {mod.__name__}')
-        globals()[attr] = getattr(mod, attr)
-    else:
-        globals()[attr] = dfault
-
-
-def importmod():
-    global MODULE
-    if MODULE is None:
-        mod = None
-    else:
-        mod = importlib.import_module(MODULE)
-        print(f'Loading methods from: {mod.__file__}')
-
-    loadmember(mod, 'getkey', lambda key: key)
-    loadmember(mod, 'getdef', lambda dfn: dfn)
-    loadmember(mod, 'mapping', {})
-
-
-args = parseargs()
-if not os.path.exists(args.output):
-    os.makedirs(args.output)
-VERBOSE = args.verbose
-FILENAME = args.file
-MODULE = args.module
-INLANG = args.source
-OUTLANG = args.target
-importmod()
-
-
-def readkey(line, defs):
-    '''
-    Add a single [term, definition] to the defs[key] dictionary.
-    line is a tab split line to be parsed.
-    '''
-    try:
-        term, defn = line.split('\t', 1)
-    except ValueError:
-        print('Bad line: "{}"'.format(line))
-        raise
-
-    term = term.strip()
-    defn = getdef(defn)
-    newl = '<br/>\n'
-    tab = '&emsp;'
-    defn = defn.replace('\\\\', '\\').\
-        replace('"', '\'').\
-        replace('>', '&gt; ').\
-        replace('<', ' &lt;').\
-        replace('（ア）', f'{newl}{tab}（ア）').\
-        replace('（イ）', f'{newl}{tab}（イ）').\
-        replace('（ウ）', f'{newl}{tab}（ウ）').\
-        replace('（エ）', f'{newl}{tab}（エ）').\
-        replace('（オ）', f'{newl}{tab}（オ）').\
-        replace('\\n', newl).\
-        strip()
-
-    nkey = normalizeUnicode(term)
-    key = getkey(nkey)
-    key = key.\
-        replace('"', '\'').\
-        replace('<', '&lt;').\
-        replace('>', '&gt;').\
-        lower().strip()
-
-    nkey = nkey.\
-        replace('"', '\'').\
-        replace('<', '&lt;').\
-        replace('>', '&gt;').\
-        lower().strip()
-
-    if key == '':
-        raise Exception(f'Missing key {term}')
-    if defn == '':
-        raise Exception(f'Missing definition {term}')
-
-    if VERBOSE:
-        print(key, ':', term)
-
-    ndef = [term, defn, key == nkey]
-    if key in defs:
-        defs[key].append(ndef)
-    else:
-        defs[key] = [ndef]
+        return getattr(mod, attr)
+    return dfault
 
 
 def inclline(s):
@@ -187,33 +195,68 @@ def inclline(s):
     return len(s) != 0 and s[0] != '#'
 
 
-def readkeys():
+def keyf(defn):
     '''
-    Iterate over FILENAME, reading lines formatted like "term {tab} definition".
-    Skips empty lines and commented out lines.
+    Order definitions by keys, then by whether the key matches the original
+    term, then by length of term then alphabetically.
     '''
-    if VERBOSE:
-        print('Reading {}'.format(FILENAME))
-    with open(FILENAME, 'r', encoding='utf-8') as fr:
-        defs = {}
+    term = defn[0]
+    if defn[2]:
+        l = 0
+    else:
+        l = len(term)
+    return l, term
+
+
+def collatedkeyf(sortkey):
+    '''
+    Returns keyf with the terms compared by their sortkey
+    '''
+    def key(defn):
+        l, term = keyf(defn)
+        return l, sortkey(term)
+    return key
 
-        for line in tqdm(filter(inclline, fr), unit='keys', desc='Reading keys'):
-            readkey(line, defs)
-        return defs
 
+# Rough size of the tuple and the ints of a spilled record, in bytes
+RECORD_OVERHEAD = 120
 
-@contextmanager
-def writekeyfile(name, i):
+# Number of records pickled together in a run file
+RUN_CHUNK = 1000
+
+
+def writerun(batch):
     '''
-    Write to key file '{name}{n}.html', put the body inside the context manager.
-    The onclick here gives a kindlegen warning but appears to be necessary to
-    actually have a lookup dictionary
+    Sort the (key, seq, term, defn, key==term) records of batch and write
+    them to a temporary file, which is deleted when it is closed.
     '''
-    fname = os.path.join(args.output, f'{name}{i}.html')
-    if VERBOSE:
-        print('Key file: {}'.format(fname))
-    with open(fname, 'w', encoding='utf-8') as to:
-        to.write('''<?xml version="1.0" encoding="utf-8"?>
+    batch.sort()
+    run = tempfile.TemporaryFile()
+    for i in range(0, len(batch), RUN_CHUNK):
+        pickle.dump(batch[i:i + RUN_CHUNK], run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def readrun(run):
+    '''
+    Iterate over the records written by writerun, one chunk at a time
+    '''
+    while True:
+        try:
+            chunk = pickle.load(run)
+        except EOFError:
+            return
+        yield from chunk
+
+
+# Buffer size of the html and opf files
+WRITE_BUFFER = 2 ** 20
+
+# The head and the tail of a key file.
+# The onclick here gives a kindlegen warning but appears to be necessary to
+# actually have a lookup dictionary
+KEYFILE_HEAD = '''<?xml version="1.0" encoding="utf-8"?>
 <html xmlns:idx="www.mobipocket.com" xmlns:mbp="www.mobipocket.com" xmlns:xlink="http://www.w3.org/1999/xlink">
   <body>
     <mbp:pagebreak/>
@@ -224,92 +267,1075 @@ def writekeyfile(name, i):
         </div>
       </mbp:slave-frame>
       <mbp:pagebreak/>
-''')
-        try:
-            yield to
-        finally:
-            to.write('''
+'''
+KEYFILE_TAIL = '''
     </mbp:frameset>
   </body>
 </html>
-        ''')
+        '''
 
+# Every definition of a key is written as ENTRY_HEAD + definition + ENTRY_TAIL
+ENTRY_HEAD = '''
+                      <idx:entry name="word" scriptable="yes">
+                        <h2>
+                          <idx:orth value="{key}">{term}</idx:orth>
+                        </h2>
+                '''
+ENTRY_TAIL = '''
+                </idx:entry>
+            '''
 
-def keyf(defn):
+# The same markup without the indentation, one entry per line
+COMPACT_KEYFILE_HEAD = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<html xmlns:idx="www.mobipocket.com" xmlns:mbp="www.mobipocket.com" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink"><body><mbp:pagebreak/>'
+    '<mbp:frameset><mbp:slave-frame display="bottom" device="all" '
+    'breadth="auto" leftmargin="0" rightmargin="0" bottommargin="0" '
+    'topmargin="0"><div align="center" bgcolor="yellow"/>'
+    '<a onclick="index_search()">Dictionary Search</a></div>'
+    '</mbp:slave-frame><mbp:pagebreak/>\n')
+COMPACT_KEYFILE_TAIL = '</mbp:frameset></body></html>\n'
+COMPACT_ENTRY_HEAD = ('<idx:entry name="word" scriptable="yes"><h2>'
+                      '<idx:orth value="{key}">{term}</idx:orth></h2>')
+COMPACT_ENTRY_TAIL = '</idx:entry>\n'
+
+# The manifest item and the spine itemref of a key file in the opf
+OPF_ITEM = '''     <item id="dictionary{ndict}" href="{name}{ndict}.html" media-type="text/x-oeb1-document"/>
+'''
+OPF_ITEMREF = '''
+	<itemref idref="dictionary{ndict}"/>
+'''
+
+# A key file template with the entry head split around the key and the term,
+# so that an entry is rendered as
+#   before_key + key + before_term + term + before_defn + defn + after_defn
+Template = namedtuple('Template', ['head', 'tail', 'before_key',
+                                   'before_term', 'before_defn',
+                                   'after_defn'])
+
+
+def compiletemplate(head, tail, entry_head, entry_tail):
     '''
-    Order definitions by keys, then by whether the key matches the original
-    term, then by length of term then alphabetically.
+    Returns the Template of a key file head and tail and an entry head with
+    a {key} and a {term} (in this order) and an entry tail
     '''
-    term = defn[0]
-    if defn[2]:
-        l = 0
-    else:
-        l = len(term)
-    return l, term
+    before_key, rest = entry_head.split('{key}')
+    before_term, before_defn = rest.split('{term}')
+    return Template(head, tail, before_key, before_term, before_defn,
+                    entry_tail)
+
+
+PRETTY = compiletemplate(KEYFILE_HEAD, KEYFILE_TAIL, ENTRY_HEAD, ENTRY_TAIL)
+COMPACT = compiletemplate(COMPACT_KEYFILE_HEAD, COMPACT_KEYFILE_TAIL,
+                          COMPACT_ENTRY_HEAD, COMPACT_ENTRY_TAIL)
+TEMPLATES = {
+    'pretty': PRETTY,
+    'compact': COMPACT,
+}
 
 
-def writekey(to, key, defn):
+@lru_cache(maxsize=None)
+def entryoverhead(template=PRETTY):
     '''
-    Write into to the key, definition pairs
+    Number of bytes an entry adds on top of its key, term and definition
+    '''
+    return len(''.join(template[2:]).encode('utf-8'))
+
+
+def renderkey(parts, key, defn, sortkey=None, template=PRETTY):
+    '''
+    Append the html fragments of the key, definition pairs
         key -> [[term, defn, key==term]]
+    to the list parts, which is joined once the whole file is rendered.
+    sortkey is the collation of the terms, see collation.py
     '''
-    terms = iter(sorted(defn, key=keyf))
-    for term, g in groupby(terms, key=lambda d: d[0]):
-        for thing in g:
-            to.write(
-                '''
-                      <idx:entry name="word" scriptable="yes">
-                        <h2>
-                          <idx:orth value="{key}">{term}</idx:orth>
-                        </h2>
-                '''.format(term=term, key=key))
-            # Merge definitions; Added sorting to display japanese results first
-            # defn = '<br/><hr>'.join(sorted(ndefn for _, ndefn, _ in g))
-            # Fixing the reading error where english definitions
-            # generate extra spacing
-            # defn.replace('<br/>\n<br/><hr>', '<br/><hr>')
-            to.write(thing[1])
-            to.write('''
-                </idx:entry>
-            ''')
+    if len(defn) > 1:
+        defn = sorted(defn, key=keyf if sortkey is None
+                      else collatedkeyf(sortkey))
+    _, _, before_key, before_term, before_defn, after_defn = template
+    for term, text, _ in defn:
+        parts.extend((before_key, key, before_term, term, before_defn, text,
+                      after_defn))
+
+
+def writeshard(output, name, i, groups, verbose=False, previous=None,
+               sortkey=None, template=PRETTY):
+    '''
+    Write the key file '{name}{i}.html' with a list of
+        (key, [[term, defn, key==term]...])
+    groups. This is a plain function so that it can run in a process pool.
+    The file is rendered as a list of fragments that is joined and written
+    at once.
+    previous is the sha256 of the file that is already there, if it's known;
+    when the new contents have the same hash the file is left untouched.
+    Returns (number of keys, size in bytes, sha256 of the contents,
+    whether it was written).
+    '''
+    parts = [template.head]
+    for key, defn in groups:
+        renderkey(parts, key, defn, sortkey, template)
+        if verbose:
+            print(key)
+    parts.append(template.tail)
+    content = ''.join(parts).encode('utf-8')
+    digest = hashlib.sha256(content).hexdigest()
+    if digest == previous:
+        return len(groups), len(content), digest, False
+    fname = os.path.join(output, f'{name}{i}.html')
+    if verbose:
+        print('Key file: {}'.format(fname))
+    # Written to a temporary file first, so that a killed run
+    # can't leave a half-written key file behind
+    tmp = f'{fname}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, fname)
+    return len(groups), len(content), digest, True
+
+
+def keyfileoverhead(template=PRETTY):
+    '''
+    Number of bytes of the head and the tail of a key file
+    '''
+    return len((template.head + template.tail).encode('utf-8'))
+
+
+def groupsize(key, defn, template=PRETTY):
+    '''
+    Number of bytes renderkey writes for the key -> [[term, defn, key==term]]
+    '''
+    keysize = len(key.encode('utf-8')) + entryoverhead(template)
+    return sum(keysize + len(term.encode('utf-8')) + len(text.encode('utf-8'))
+               for term, text, _ in defn)
+
+
+def planshards(groups, maxkeys=10000, maxbytes=0, template=PRETTY):
+    '''
+    Cut the sorted (key, [[term, defn, key==term]...]) groups into lists
+    for the key files, with at most maxkeys keys and, if maxbytes is set,
+    at most maxbytes bytes each. A key that is bigger than
+    maxbytes on its own gets a file to itself.
+    '''
+    overhead = keyfileoverhead(template)
+    shard, size = [], overhead
+    for key, defn in groups:
+        if maxbytes > 0:
+            gsize = groupsize(key, defn, template)
+            if shard and size + gsize > maxbytes:
+                yield shard
+                shard, size = [], overhead
+            size += gsize
+        shard.append((key, defn))
+        if len(shard) >= maxkeys:
+            yield shard
+            shard, size = [], overhead
+    if shard:
+        yield shard
+
+
+def planvolumes(sizes, volumes):
+    '''
+    Cut the key files with the given sizes (in bytes, in key order) into at
+    most volumes consecutive ranges of about the same size.
+    Returns the (start, stop) indices of every range, none of them empty.
+    '''
+    if not sizes:
+        return []
+    cumulative = [0]
+    for size in sizes:
+        cumulative.append(cumulative[-1] + size)
+    total = cumulative[-1]
+    bounds = [0]
+    for k in range(1, volumes):
+        target = total * k / volumes
+        # The file boundary closest to the target, after the previous one
+        cut = bisect.bisect_left(cumulative, target)
+        if cut > 0 and target - cumulative[cut - 1] < cumulative[cut] - target:
+            cut -= 1
+        if bounds[-1] < cut < len(sizes):
+            bounds.append(cut)
+    bounds.append(len(sizes))
+    return list(zip(bounds, bounds[1:]))
+
+
+def volumelabel(key):
+    '''
+    The first character of an (escaped) key, for the title of a volume
+    '''
+    return html.escape(html.unescape(key)[:1])
+
+
+def shardreport(stats):
+    '''
+    Summary of the (number of keys, size in bytes) of the written key files
+    '''
+    if not stats:
+        return 'No html files written'
+    sizes = sorted(size for _, size in stats)
+    keys = sorted(nkeys for nkeys, _ in stats)
+    return (f'{len(stats)} html files, '
+            f'size min/median/max {sizes[0]}/{sizes[len(sizes) // 2]}/'
+            f'{sizes[-1]} bytes, total {sum(sizes)} bytes, '
+            f'keys min/median/max {keys[0]}/{keys[len(keys) // 2]}/{keys[-1]}')
+
+
+class ShardCache:
+    '''
+    Remembers the sha256, size and mtime of every key file of a dictionary in
+    {cache_dir}/{name}.shards.json, so that the files whose contents didn't
+    change are not written again by the next run.
+    '''
+
+    def __init__(self, cache_dir, name):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f'{name}.shards.json')
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+        self.kept = 0
+
+    def previous(self, fname):
+        '''
+        The sha256 of fname from the last run, None if fname was changed since
+        '''
+        entry = self.files.get(os.path.basename(fname))
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        if (entry is None or stat.st_size != entry['size']
+                or stat.st_mtime_ns != entry['mtime']):
+            return None
+        return entry['digest']
 
-    if VERBOSE:
-        print(key)
+    def record(self, fname, digest, written):
+        stat = os.stat(fname)
+        self.files[os.path.basename(fname)] = {
+            'digest': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        if not written:
+            self.kept += 1
 
+    def save(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
 
-def writekeys(defns, name):
+
+class ShardProgress:
+    '''
+    Records which key files of a dictionary are complete in
+    {output}/{name}.progress.jsonl, together with the settings and the input
+    they were written with. A resumed run with the same settings and input
+    plans the same key files and skips the ones that are complete.
+
+    The first line holds the settings, then every complete file appends a
+    line of its own, so recording a file costs the same no matter how many
+    came before it. A line cut short by a killed run is ignored.
+    The file is removed once the opf is written.
+    '''
+
+    def __init__(self, output, name, settings, resume=False):
+        self.path = os.path.join(output, f'{name}.progress.jsonl')
+        self.settings = settings
+        self.files = {}
+        self.resumed = 0
+        if resume:
+            self.files = self.load()
+        # Written again from what was loaded, which also drops a cut line
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            self.writeline(f, {'settings': settings})
+            for fname, entry in self.files.items():
+                self.writeline(f, dict(entry, file=fname))
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def load(self):
+        '''
+        The complete files of an earlier run with the same settings
+        '''
+        files = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                if json.loads(f.readline()) != {'settings': self.settings}:
+                    return {}
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    files[entry.pop('file')] = entry
+        except (OSError, ValueError, KeyError):
+            return {}
+        return files
+
+    @staticmethod
+    def writeline(f, record):
+        f.write(json.dumps(record, ensure_ascii=False))
+        f.write('\n')
+
+    def finished(self, fname):
+        '''
+        The (number of keys, size in bytes, sha256, False) of fname if it was
+        completed by an earlier run and is still there, None otherwise
+        '''
+        entry = self.files.get(os.path.basename(fname))
+        try:
+            if entry is None or os.path.getsize(fname) != entry['size']:
+                return None
+        except OSError:
+            return None
+        self.resumed += 1
+        return entry['keys'], entry['size'], entry['digest'], False
+
+    def record(self, fname, result):
+        nkeys, size, digest, _ = result
+        entry = {'keys': nkeys, 'size': size, 'digest': digest}
+        self.files[os.path.basename(fname)] = entry
+        self.writeline(self.file, dict(entry, file=os.path.basename(fname)))
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self):
+        self.close()
+        self.files = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class KeyIndex:
     '''
-    Write all the keys, where defns is a map of
-        key --> [[term, defn, key==term]...]
-    and name is the basename.
+    A memory-mapped tab file indexed by key.
 
-    The files are split so that there are no more than 10,000 keys written
-    to each file. (why?? I dunno. Probably to reduce lag when opening them.)
+    Only the distinct keys are kept as strings. Every line is stored as the
+    id of its key, the offsets of its start, its tab and its end and the
+    key==term flag, all in arrays, so a line costs a few dozen bytes no
+    matter how long its definition is. The terms and the definitions are
+    decoded from the file when they are needed.
 
-    Returns the number of files.
+    The mapped pages are clean file pages, but they still count towards the
+    RSS of the process, so they are released every release_bytes bytes read.
     '''
-    keyit = iter(sorted(defns))
-    for j in tqdm(count(), unit='files', desc='Writing html'):
-        with writekeyfile(name, j) as to:
-            keys = list(islice(keyit, 10000))
-            if len(keys) == 0:
-                break
-            for key in keys:
-                writekey(to, key, defns[key])
-    return j + 1
 
+    release_bytes = 16 * 2 ** 20
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = {}
+        self.keyids = array('l')
+        self.starts = array('q')
+        self.tabs = array('q')
+        self.ends = array('q')
+        self.matches = array('b')
+        self.unreleased = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lines(self):
+        '''
+        Iterate over the (start, tab, end) offsets of the lines that
+        inclline keeps, end includes the newline. tab is -1 if there is none.
+        Raises UnindexableInput on a \r, as the text mode of readkeys
+        would treat it as a line break too.
+        '''
+        mm = self.mm
+        start, size = 0, len(mm)
+        while start < size:
+            end = mm.find(b'\n', start) + 1 or size
+            if mm.find(b'\r', start, end) != -1:
+                raise UnindexableInput(f'\\r at offset {start}')
+            tab = mm.find(b'\t', start, end)
+            # The same check as inclline, without decoding the definition
+            head = self.text(start, end if tab == -1 else tab).lstrip()
+            if not head and tab != -1:
+                head = self.text(start, end).lstrip()
+            if head and head[0] != '#':
+                yield start, tab, end
+            self.read(end - start)
+            start = end
 
-@contextmanager
-def openopf(ndicts, name):
+    def text(self, start, end):
+        return self.mm[start:end].decode('utf-8')
+
+    def read(self, size):
+        '''
+        Count size bytes as read, releases the mapped pages when
+        release_bytes have been read since the last time
+        '''
+        self.unreleased += size
+        if self.unreleased >= self.release_bytes:
+            self.release()
+
+    def release(self):
+        '''
+        Drop the mapped pages, they stay in the page cache
+        '''
+        self.unreleased = 0
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            self.mm.madvise(mmap.MADV_DONTNEED)
+
+    def add(self, key, start, tab, end, match):
+        self.keyids.append(self.keys.setdefault(key, len(self.keys)))
+        self.starts.append(start)
+        self.tabs.append(tab)
+        self.ends.append(end)
+        self.matches.append(match)
+
+    def sortedkeys(self, sortkey=None):
+        '''
+        Returns the keys sorted by sortkey and an array with the lines
+        grouped by key:
+        the lines of the n-th key come at bounds[n]:bounds[n + 1].
+        The lines of a key stay in the order of the file, like in readkeys.
+        '''
+        keys = sorted(self.keys, key=sortkey)
+        ranks = array('l', [0]) * len(keys)
+        for rank, key in enumerate(keys):
+            ranks[self.keys[key]] = rank
+        # Counting sort by the rank of the key
+        bounds = array('q', [0]) * (len(keys) + 1)
+        for keyid in self.keyids:
+            bounds[ranks[keyid] + 1] += 1
+        for rank in range(len(keys)):
+            bounds[rank + 1] += bounds[rank]
+        positions = array('q', bounds)
+        order = array('q', [0]) * len(self)
+        for line, keyid in enumerate(self.keyids):
+            rank = ranks[keyid]
+            order[positions[rank]] = line
+            positions[rank] += 1
+        return keys, bounds, order
+
+
+class UnindexableInput(Exception):
     '''
-    After writing keys, the opf that references all the key files is constructed.
-    openopf wraps the contents of writeopf
+    Raised by KeyIndex when the input can't be read with offsets
     '''
-    fname = os.path.join(args.output, f'{name}.opf')
-    if VERBOSE:
-        print(f'Opf: {fname}')
-    with open(fname, 'w', encoding='utf-8') as to:
-        to.write('''<?xml version="1.0"?><!DOCTYPE package SYSTEM "oeb1.ent">
+
+
+class UnsortedInput(Exception):
+    '''
+    Raised by Tab2Opf.readsorted when the input is not sorted by key
+    '''
+
+
+class Tab2Opf:
+    '''
+    Converts tab files into OPF/html dictionaries.
+
+    All of the configuration is explicit, so a single instance can be used
+    to convert any number of dictionaries in one process:
+
+        converter = Tab2Opf(output='opf', module='mymodule')
+        converter.convert('dict1.tab')
+        converter.convert('dict2.tab')
+
+    The time and memory of every stage are collected in metrics,
+    see metrics.Metrics.
+    '''
+
+    def __init__(self, output='opf', module=None, source='ja', target='ja',
+                 verbose=False, key_cache=2 ** 16, presorted='auto',
+                 memory_budget=0, jobs=1, cache_dir=None, shard_keys=10000,
+                 shard_bytes=0, metrics=None, storage='mmap',
+                 collation='codepoint', html='pretty', resume=False,
+                 volumes=1):
+        self.output = output
+        self.volumes = volumes
+        self.shardkeys = []
+        self.html = html
+        self.template = TEMPLATES[html]
+        self.resume = resume
+        self.progress = None
+        self.collation = collation
+        self.sortkey = COLLATIONS[collation]
+        self.storage = storage
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.shard_keys = shard_keys
+        self.shard_bytes = shard_bytes
+        self.shardstats = []
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.shardcache = None
+        self.presorted = presorted
+        self.memory_budget = memory_budget
+        self.source = source
+        self.target = target
+        self.verbose = verbose
+        self.key_cache = key_cache
+        self.importmod(module)
+
+    def importmod(self, module=None):
+        '''
+        Load getkey, getdef, mapping, defrules & keyrules from module
+        and compile them.
+        '''
+        self.module = module
+        if module is None:
+            mod = None
+        else:
+            mod = importlib.import_module(module)
+            print(f'Loading methods from: {mod.__file__}')
+
+        self.getkey = loadmember(mod, 'getkey', lambda key: key)
+        self.getdef = loadmember(mod, 'getdef', lambda dfn: dfn)
+        self.mapping = loadmember(mod, 'mapping', {})
+        defrules = loadmember(mod, 'defrules', [])
+        keyrules = loadmember(mod, 'keyrules', [])
+
+        # The module rules are applied after the default ones
+        self.escapedef = Escaper(DEF_RULES + list(defrules), strip=True)
+        self.escaperawdef = Escaper(RAW_DEF_RULES + list(defrules),
+                                    strip=True)
+        self.escapekey = Escaper(KEY_RULES + list(keyrules), strip=True,
+                                 lower=True)
+
+        # Only single characters were ever looked up in mapping
+        table = {ch: to for ch, to in self.mapping.items() if len(ch) == 1}
+        self.mappingtable = str.maketrans(table) if table else None
+
+        # yomi2tab duplicates the headwords with their readings,
+        # so the same terms come up over and over again
+        if self.key_cache > 0:
+            self.getkeys = lru_cache(maxsize=self.key_cache)(self.derivekeys)
+        else:
+            self.getkeys = self.derivekeys
+
+    def normalizeUnicode(self, text):
+        '''
+        Reduce some characters to something else.
+        Uses the str.translate table compiled from mapping by importmod,
+        and does nothing when the mapping is empty.
+        '''
+        if self.mappingtable is None:
+            return text
+        return text.translate(self.mappingtable)
+
+    def collate(self, key):
+        '''
+        Returns what key is compared by in the collation of the converter
+        '''
+        if self.sortkey is None:
+            return key
+        return self.sortkey(key)
+
+    def derivekeys(self, term):
+        '''
+        Returns (key, nkey) for a term: key is the escaped and lowercased
+        getkey(normalizeUnicode(term)), nkey is the same without getkey.
+        '''
+        nkey = self.normalizeUnicode(term)
+        key = self.getkey(nkey)
+        if key == nkey:
+            nkey = key = self.escapekey(nkey)
+        else:
+            key = self.escapekey(key)
+            nkey = self.escapekey(nkey)
+        return key, nkey
+
+    def readkey(self, line, defs):
+        '''
+        Add a single [term, definition] to the defs[key] dictionary.
+        line is a tab split line to be parsed.
+        '''
+        key, ndef = self.parseline(line)
+        if key in defs:
+            defs[key].append(ndef)
+        else:
+            defs[key] = [ndef]
+
+    def parseline(self, line):
+        '''
+        Parse a tab split line into (key, [term, definition, key==term])
+        '''
+        try:
+            term, defn = line.split('\t', 1)
+        except ValueError:
+            print('Bad line: "{}"'.format(line))
+            raise
+        return self.parsekey(term, defn, self.escapedef)
+
+    def addkey(self, term, defn, defs, escapedef):
+        '''
+        Add a single [term, definition] to the defs[key] dictionary,
+        escaping the definition with escapedef.
+        '''
+        key, ndef = self.parsekey(term, defn, escapedef)
+        if key in defs:
+            defs[key].append(ndef)
+        else:
+            defs[key] = [ndef]
+
+    def parsekey(self, term, defn, escapedef):
+        '''
+        Returns (key, [term, definition, key==term]) for a single entry,
+        escaping the definition with escapedef.
+        '''
+        term = term.strip()
+        defn = escapedef(self.getdef(defn))
+
+        key, nkey = self.getkeys(term)
+
+        if key == '':
+            raise Exception(f'Missing key {term}')
+        if defn == '':
+            raise Exception(f'Missing definition {term}')
+
+        if self.verbose:
+            print(key, ':', term)
+
+        return key, [term, defn, key == nkey]
+
+    def readkeys(self, filename):
+        '''
+        Iterate over filename, reading lines formatted like "term {tab} definition".
+        Skips empty lines and commented out lines.
+        '''
+        if self.verbose:
+            print('Reading {}'.format(filename))
+        with open(filename, 'r', encoding='utf-8') as fr, \
+                self.metrics.stage('read keys') as stage:
+            defs = {}
+
+            lines = 0
+            for lines, line in enumerate(tqdm(filter(inclline, fr), unit='keys',
+                                              desc='Reading keys'), start=1):
+                self.readkey(line, defs)
+            stage['records'] = lines
+            if self.verbose and hasattr(self.getkeys, 'cache_info'):
+                print(f'Key cache: {self.getkeys.cache_info()}')
+            return defs
+
+    def readrecords(self, records):
+        '''
+        Same as readkeys, but for an iterable of (term, definition) records
+        that never went through a tab file, so the definitions have real
+        newlines instead of escaped ones.
+        '''
+        defs = {}
+        with self.metrics.stage('read keys') as stage:
+            lines = 0
+            for lines, (term, defn) in enumerate(
+                    tqdm(records, unit='keys', desc='Reading keys'), start=1):
+                self.addkey(term, defn, defs, self.escaperawdef)
+            stage['records'] = lines
+        if self.verbose and hasattr(self.getkeys, 'cache_info'):
+            print(f'Key cache: {self.getkeys.cache_info()}')
+        return defs
+
+    def issorted(self, filename):
+        '''
+        Check whether the lines of filename are already sorted by their keys.
+        Only the keys are derived, the definitions are not touched,
+        and the check stops at the first key that is out of order.
+        '''
+        prev = None
+        with open(filename, 'r', encoding='utf-8') as fr, \
+                self.metrics.stage('check sorted'):
+            for line in filter(inclline, fr):
+                key, _ = self.getkeys(line.split('\t', 1)[0].strip())
+                key = self.collate(key)
+                if prev is not None and key < prev:
+                    return False
+                prev = key
+        return True
+
+    def readsorted(self, filename):
+        '''
+        Iterate over filename whose lines are sorted by key, yielding
+            (key, [[term, defn, key==term]...])
+        for every group of consecutive lines with the same key, so that only
+        one group has to be in memory.
+        Raises UnsortedInput as soon as a key is out of order.
+        '''
+        if self.verbose:
+            print('Reading {} (sorted)'.format(filename))
+        with open(filename, 'r', encoding='utf-8') as fr:
+            groupkey, group = None, []
+            # The collated groupkey, so every key is collated only once
+            groupsortkey = None
+            for line in tqdm(filter(inclline, fr), unit='keys', desc='Reading keys'):
+                key, ndef = self.parseline(line)
+                if key != groupkey:
+                    if group:
+                        yield groupkey, group
+                    sortkey = self.collate(key)
+                    if groupkey is not None and sortkey < groupsortkey:
+                        raise UnsortedInput(
+                            f'{filename}: key {key} comes after {groupkey}')
+                    groupkey, groupsortkey, group = key, sortkey, []
+                group.append(ndef)
+            if group:
+                yield groupkey, group
+
+    def readspilled(self, filename):
+        '''
+        Same as self.sortedgroups(self.readkeys(filename)), but with bounded
+        memory.
+        The entries are collected until they reach memory_budget megabytes,
+        then sorted and written as a run to a temporary file.
+        The runs are merged back with heapq.merge, yielding
+            (key, [[term, defn, key==term]...])
+        groups in the same order and with the same contents as the in-memory
+        path: the line number breaks the ties between equal keys.
+        '''
+        if self.verbose:
+            print('Reading {} (spilling to disk)'.format(filename))
+        budget = self.memory_budget * 2 ** 20
+        runs = []
+        try:
+            with open(filename, 'r', encoding='utf-8') as fr:
+                batch, size = [], 0
+                lines = tqdm(filter(inclline, fr), unit='keys', desc='Reading keys')
+                for seq, line in enumerate(lines):
+                    key, (term, defn, match) = self.parseline(line)
+                    batch.append((self.collate(key), seq, key, term, defn,
+                                  match))
+                    size += (sys.getsizeof(key) + sys.getsizeof(term)
+                             + sys.getsizeof(defn) + RECORD_OVERHEAD)
+                    if size >= budget:
+                        runs.append(writerun(batch))
+                        batch, size = [], 0
+                if batch:
+                    runs.append(writerun(batch))
+                    batch = []
+            if self.verbose:
+                print(f'Merging {len(runs)} sorted runs')
+            merged = heapq.merge(*(readrun(run) for run in runs))
+            for _, records in groupby(merged, key=itemgetter(0)):
+                records = list(records)
+                yield records[0][2], [[term, defn, match]
+                                      for _, _, _, term, defn, match in records]
+        finally:
+            for run in runs:
+                run.close()
+
+    def readindex(self, filename):
+        '''
+        Same as readkeys, but only the keys are derived and the lines are
+        kept as offsets into the memory-mapped file, see KeyIndex.
+        Raises UnindexableInput if the file can't be indexed: when it is
+        empty or has \r line endings, which readkeys would translate.
+        '''
+        if self.verbose:
+            print('Reading {} (memory-mapped)'.format(filename))
+        if os.path.getsize(filename) == 0:
+            raise UnindexableInput(f'{filename} is empty')
+        index = KeyIndex(filename)
+        try:
+            with self.metrics.stage('read keys') as stage:
+                for start, tab, end in tqdm(index.lines(), unit='keys',
+                                            desc='Reading keys'):
+                    if tab == -1:
+                        print('Bad line: "{}"'.format(index.text(start, end)))
+                        raise ValueError('not enough values to unpack '
+                                         '(expected 2, got 1)')
+                    term = index.text(start, tab).strip()
+                    key, nkey = self.getkeys(term)
+                    if key == '':
+                        raise Exception(f'Missing key {term}')
+                    if self.verbose:
+                        print(key, ':', term)
+                    index.add(key, start, tab, end, key == nkey)
+                stage['records'] = len(index)
+        except BaseException:
+            index.close()
+            raise
+        if self.verbose and hasattr(self.getkeys, 'cache_info'):
+            print(f'Key cache: {self.getkeys.cache_info()}')
+        return index
+
+    def indexedgroups(self, index):
+        '''
+        Iterate over a KeyIndex in key order, yielding
+            (key, [[term, defn, key==term]...])
+        groups with the definitions escaped, just like
+        self.sortedgroups(self.readkeys(filename))
+        '''
+        with self.metrics.stage('sort keys') as stage:
+            keys, bounds, order = index.sortedkeys(self.sortkey)
+            stage['records'] = len(keys)
+        for rank, key in enumerate(keys):
+            group = []
+            for line in order[bounds[rank]:bounds[rank + 1]]:
+                tab = index.tabs[line]
+                term = index.text(index.starts[line], tab).strip()
+                end = index.ends[line]
+                defn = self.escapedef(self.getdef(index.text(tab + 1, end)))
+                index.read(end - tab)
+                if defn == '':
+                    raise Exception(f'Missing definition {term}')
+                group.append([term, defn, bool(index.matches[line])])
+            yield key, group
+
+    def indexdatabase(self, connection):
+        '''
+        Same as readindex for a database written by yomi2tab --format sqlite:
+        derives the key of every entry and stores it in the keys table,
+        together with its sortkey, then indexes the table by sortkey.
+        The keys are kept in the database with the settings they were
+        derived with (see keysettings) and are only derived again when the
+        settings or the entries change. A database that can't be written
+        gets its keys in a temporary database instead.
+        Returns the schema of the keys table: main or work.
+        '''
+        settings = json.dumps(self.keysettings(connection))
+        if read_meta(connection, 'keys') == settings:
+            print('Reading the keys stored in the database')
+            return 'main'
+        try:
+            # Forgotten first, so that a killed run leaves no stale keys
+            connection.execute("DELETE FROM meta WHERE name = 'keys'")
+            connection.commit()
+            self.writedatabasekeys(connection, 'main')
+            connection.execute('INSERT INTO meta VALUES (?, ?)',
+                               ('keys', settings))
+            connection.commit()
+            return 'main'
+        except sqlite3.OperationalError as e:
+            connection.rollback()
+            print(f'Can\'t store the keys in the database ({e}), '
+                  'keeping them in a temporary one.')
+        connection.execute(ATTACH_WORK)
+        self.writedatabasekeys(connection, 'work')
+        connection.commit()
+        return 'work'
+
+    def writedatabasekeys(self, connection, schema):
+        '''
+        Derives the keys of all the entries into the keys table of schema
+        '''
+        connection.executescript(KEYS_SCHEMA.format(schema=schema))
+        entries = connection.execute('SELECT id, word FROM entries ORDER BY id')
+        with self.metrics.stage('read keys') as stage:
+            def keys():
+                for entry, term in tqdm(entries, unit='keys',
+                                        desc='Reading keys'):
+                    term = term.strip()
+                    key, nkey = self.getkeys(term)
+                    if key == '':
+                        raise Exception(f'Missing key {term}')
+                    if self.verbose:
+                        print(key, ':', term)
+                    yield entry, key, self.collate(key), key == nkey
+            # A second cursor, entries is still being read
+            connection.cursor().executemany(
+                f'INSERT INTO {schema}.keys VALUES (?, ?, ?, ?)', keys())
+            stage['records'] = connection.execute(
+                f'SELECT count(*) FROM {schema}.keys').fetchone()[0]
+        with self.metrics.stage('sort keys'):
+            connection.execute(KEYS_INDEX.format(schema=schema))
+        if self.verbose and hasattr(self.getkeys, 'cache_info'):
+            print(f'Key cache: {self.getkeys.cache_info()}')
+
+    def keysettings(self, connection):
+        '''
+        Everything the stored keys of a database depend on: the settings
+        of the converter and the number and the last id of the entries
+        '''
+        entries, last = connection.execute(
+            'SELECT count(*), max(id) FROM entries').fetchone()
+        return {'version': VERSION, 'module': self.module,
+                'collation': self.collation, 'entries': entries,
+                'last': last}
+
+    def databasegroups(self, connection, schema='main', start=None,
+                       stop=None):
+        '''
+        Iterate over a database indexed by indexdatabase in key order,
+        yielding
+            (key, [[term, defn, key==term]...])
+        groups with the definitions escaped, just like indexedgroups.
+        The definitions are read from the database when they are written.
+        start and stop limit the groups to the keys (as they are written to
+        the html) from start up to, but not including, stop. The range is
+        looked up in the index, the other entries are not read.
+        '''
+        bounds, params = [], []
+        if start is not None:
+            bounds.append('k.sortkey >= ?')
+            params.append(self.collate(start))
+        if stop is not None:
+            bounds.append('k.sortkey < ?')
+            params.append(self.collate(stop))
+        where = f'WHERE {" AND ".join(bounds)} ' if bounds else ''
+        rows = connection.execute(
+            f'SELECT k.key, e.word, e.definition, k.match FROM {schema}.keys k '
+            f'JOIN main.entries e ON e.id = k.entry {where}'
+            'ORDER BY k.sortkey, k.entry', params)
+        for key, group in groupby(rows, itemgetter(0)):
+            defns = []
+            for _, term, defn, match in group:
+                term = term.strip()
+                defn = self.escaperawdef(self.getdef(defn))
+                if defn == '':
+                    raise Exception(f'Missing definition {term}')
+                defns.append([term, defn, bool(match)])
+            yield key, defns
+
+    def writekeys(self, defns, name):
+        '''
+        Write all the keys, where defns is a map of
+            key --> [[term, defn, key==term]...]
+        and name is the basename.
+
+        The files are split so that there are no more than shard_keys
+        (10,000 by default) keys written to each file. (why?? I dunno.
+        Probably to reduce lag when opening them.) If shard_bytes is set,
+        the files are also kept under that many bytes.
+
+        Returns the number of files.
+        '''
+        return self.writegroups(self.sortedgroups(defns), name)
+
+    def sortedgroups(self, defns):
+        '''
+        Iterate over the key --> [[term, defn, key==term]...] map in the
+        collation of the converter. The keys are sorted right away, so that
+        the sort is measured as a stage of its own
+        '''
+        with self.metrics.stage('sort keys') as stage:
+            keys = sorted(defns, key=self.sortkey)
+            stage['records'] = len(keys)
+        return ((key, defns[key]) for key in keys)
+
+    def writegroups(self, groups, name):
+        '''
+        Same as writekeys, but for an iterable of
+            (key, [[term, defn, key==term]...])
+        that is already sorted by key. The groups are written as they come.
+        '''
+        shards = self.trackkeys(planshards(groups, self.shard_keys,
+                                           self.shard_bytes, self.template))
+        self.shardstats = []
+        self.shardkeys = []
+        # With presorted or spilled input the groups are read while they are
+        # written, so this stage includes the reading too
+        with self.metrics.stage('write html') as stage:
+            if self.jobs > 1:
+                nfiles = self.writeshardsparallel(shards, name)
+            else:
+                nfiles = 0
+                for j, shard in enumerate(tqdm(shards, unit='files',
+                                               desc='Writing html')):
+                    self.writeshard(name, j, shard)
+                    nfiles = j + 1
+            # The last file has always been an empty one
+            self.shardkeys.append(None)
+            self.writeshard(name, nfiles, [])
+            stage['records'] = sum(stat[0] for stat in self.shardstats)
+        print(shardreport([stat for stat in self.shardstats if stat[0] > 0]))
+        return nfiles + 1
+
+    def trackkeys(self, shards):
+        '''
+        Pass the planned shards through, remembering their first and last key
+        '''
+        for shard in shards:
+            self.shardkeys.append((shard[0][0], shard[-1][0]))
+            yield shard
+
+    def writeshardsparallel(self, shards, name):
+        '''
+        Write the planned shards with a pool of jobs processes.
+        Only a few shards per process are in flight at a time.
+        Returns the number of files written.
+        '''
+        nfiles = 0
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor, \
+                tqdm(unit='files', desc='Writing html') as progress:
+            pending = deque()
+            for j, shard in enumerate(shards):
+                fname = os.path.join(self.output, f'{name}{j}.html')
+                nfiles = j + 1
+                finished = self.finishedshard(fname)
+                if finished is not None:
+                    self.recordshard(fname, finished)
+                    progress.update()
+                    continue
+                future = executor.submit(writeshard, self.output, name, j,
+                                         shard, self.verbose,
+                                         self.previousdigest(fname),
+                                         self.sortkey, self.template)
+                pending.append((fname, future))
+                while len(pending) > 2 * self.jobs:
+                    done, future = pending.popleft()
+                    self.recordshard(done, future.result())
+                    progress.update()
+            for fname, future in pending:
+                self.recordshard(fname, future.result())
+                progress.update()
+        return nfiles
+
+    def writeshard(self, name, j, groups):
+        '''
+        Write a single key file in this process, see writeshard
+        '''
+        fname = os.path.join(self.output, f'{name}{j}.html')
+        finished = self.finishedshard(fname)
+        if finished is not None:
+            self.recordshard(fname, finished)
+            return
+        self.recordshard(fname, writeshard(self.output, name, j, groups,
+                                           self.verbose,
+                                           self.previousdigest(fname),
+                                           self.sortkey, self.template))
+
+    def finishedshard(self, fname):
+        '''
+        The result of writeshard for fname if a resumed run finished it
+        '''
+        if self.progress is None or not self.resume:
+            return None
+        return self.progress.finished(fname)
+
+    def previousdigest(self, fname):
+        if self.shardcache is None:
+            return None
+        return self.shardcache.previous(fname)
+
+    def recordshard(self, fname, result):
+        nkeys, size, digest, written = result
+        self.shardstats.append((nkeys, size))
+        if self.progress is not None:
+            self.progress.record(fname, result)
+        if self.shardcache is not None:
+            self.shardcache.record(fname, digest, written)
+
+    @contextmanager
+    def openopf(self, ndicts, name, title=None):
+        '''
+        After writing keys, the opf that references all the key files is constructed.
+        openopf wraps the contents of writeopf.
+        name is the basename and the identifier of the opf, title defaults to it
+        '''
+        if title is None:
+            title = name
+        fname = os.path.join(self.output, f'{name}.opf')
+        if self.verbose:
+            print(f'Opf: {fname}')
+        tmp = f'{fname}.tmp'
+        with open(tmp, 'w', encoding='utf-8', buffering=WRITE_BUFFER) as to:
+            to.write('''<?xml version="1.0"?><!DOCTYPE package SYSTEM "oeb1.ent">
 
 <!-- the command line instruction 'prcgen dictionary.opf' will produce the dictionary.prc file in the same folder-->
 <!-- the command line instruction 'mobigen dictionary.opf' will produce the dictionary.mobi file in the same folder-->
@@ -320,7 +1346,7 @@ def openopf(ndicts, name):
 	<dc-metadata>
 		<dc:Identifier id="uid">{name}</dc:Identifier>
 		<!-- Title of the document -->
-		<dc:Title><h2>{name}</h2></dc:Title>
+		<dc:Title><h2>{title}</h2></dc:Title>
 		<dc:Language>ja</dc:Language>
 	</dc-metadata>
 	<x-metadata>
@@ -332,49 +1358,213 @@ def openopf(ndicts, name):
 
 <!-- list of all the files needed to produce the .prc file -->
 <manifest>
-'''.format(name=name, source=INLANG, target=OUTLANG))
+'''.format(name=name, title=title, source=self.source,
+           target=self.target))
 
-        yield to
+            yield to
 
-        to.write('''
+            to.write('''
 <tours/>
 <guide> <reference type="search" title="Dictionary Search" onclick= "index_search()"/> </guide>
 </package>
 '''
-                 )
-
-# Write the opf that describes all the key files
-
+                     )
+        os.replace(tmp, fname)
 
-def writeopf(ndicts, name):
-    with openopf(ndicts, name) as to:
-        for i in range(ndicts):
-            to.write(
-                '''     <item id="dictionary{ndict}" href="{name}{ndict}.html" media-type="text/x-oeb1-document"/>
-'''.format(ndict=i, name=name))
-
-        to.write('''
+    # Write the opf that describes all the key files, or only the files
+    # of a volume: files are their numbers and opfname the name of its opf
+    def writeopf(self, ndicts, name, files=None, opfname=None, title=None):
+        if files is None:
+            files = range(ndicts)
+        parts = [OPF_ITEM.format(ndict=i, name=name) for i in files]
+        parts.append('''
 </manifest>
 <!-- list of the html files in the correct order  -->
 <spine>
-'''
-                 )
-        for i in range(ndicts):
-            to.write('''
-	<itemref idref="dictionary{ndict}"/>
-'''.format(ndict=i))
-
-        to.write('''
+''')
+        parts.extend(OPF_ITEMREF.format(ndict=i) for i in files)
+        parts.append('''
 </spine>
 ''')
+        with self.openopf(ndicts, opfname or name, title) as to:
+            to.write(''.join(parts))
+
+    def writevolumes(self, ndicts, name):
+        '''
+        Write the opf of every volume: a range of consecutive key files with
+        about the same size in bytes, see planvolumes. The volumes are named
+        {name}_1, {name}_2... and titled by their first and last key.
+        Returns the paths of the opfs.
+        '''
+        sizes = [size for _, size in self.shardstats]
+        # The trailing empty key file would skew the balance and could end up
+        # as a volume of its own, so the volumes are planned over the files
+        # with keys and it is added to the last one
+        nfiles = self.shardkeys.index(None)
+        ranges = planvolumes(sizes[:nfiles], self.volumes) or [(0, 0)]
+        ranges[-1] = (ranges[-1][0], len(sizes))
+        opfs = []
+        for volume, (start, stop) in enumerate(ranges, start=1):
+            keys = [k for k in self.shardkeys[start:stop] if k is not None]
+            title = name
+            if keys:
+                title = (f'{name} {volumelabel(keys[0][0])}–'
+                         f'{volumelabel(keys[-1][1])}')
+            opfname = f'{name}_{volume}'
+            self.writeopf(ndicts, name, range(start, stop), opfname, title)
+            opfs.append(os.path.join(self.output, f'{opfname}.opf'))
+            print(f'Volume {opfname}: {title}, {stop - start} html files, '
+                  f'{sum(sizes[start:stop])} bytes')
+        return opfs
+
+    def convert(self, filename, name=None):
+        '''
+        Convert a single tab file, returns the path of the written opf.
+        name is the basename of the output files and defaults to the
+        name of the tab file.
+        '''
+        if name is None:
+            name = os.path.splitext(os.path.basename(filename))[0]
+
+        # Databases from yomi2tab --format sqlite have no escaped newlines
+        # and are read in key order through their own index
+        if isdatabase(filename):
+            connection = open_database(filename)
+            try:
+                schema = self.indexdatabase(connection)
+                # After the keys are stored, which changes the file
+                source = self.inputsettings(filename)
+                return self.writedictionary(
+                    self.databasegroups(connection, schema), name, source)
+            finally:
+                connection.close()
+
+        source = self.inputsettings(filename)
+
+        # Sorted input (e.g. from yomi2tab) is written while it is read.
+        # If it turns out to be unsorted after all, everything is redone
+        # the usual way and the written files are overwritten
+        if self.presorted == 'yes' or (self.presorted == 'auto'
+                                       and self.issorted(filename)):
+            try:
+                return self.writedictionary(self.readsorted(filename), name,
+                                            source)
+            except UnsortedInput as e:
+                print(f'The input is not sorted ({e}), reading it again.')
+        if self.memory_budget > 0:
+            return self.writedictionary(self.readspilled(filename), name,
+                                        source)
+        if self.storage == 'mmap':
+            try:
+                index = self.readindex(filename)
+            except UnindexableInput as e:
+                print(f'The input can\'t be memory-mapped ({e}), '
+                      'reading it into memory.')
+            else:
+                with index:
+                    return self.writedictionary(self.indexedgroups(index),
+                                                name, source)
+        return self.writedictionary(self.sortedgroups(self.readkeys(filename)),
+                                    name, source)
+
+    def convertrecords(self, records, name):
+        '''
+        Convert an iterable of (term, definition) records with real newlines,
+        returns the path of the written opf.
+        '''
+        return self.writedictionary(
+            self.sortedgroups(self.readrecords(records)), name)
+
+    def writedictionary(self, groups, name, source=None):
+        '''
+        Write the html files and the opf for the sorted
+            (key, [[term, defn, key==term]...])
+        groups, returns the path of the opf (with volumes > 1, a list of the
+        paths of the volume opfs).
+        source identifies the input (see inputsettings): if it is set, the
+        complete html files are recorded in a ShardProgress, so that a run
+        with resume can skip them.
+        '''
+        if not os.path.exists(self.output):
+            os.makedirs(self.output)
+        if self.cache_dir is not None:
+            self.shardcache = ShardCache(self.cache_dir, name)
+        if source is not None:
+            self.progress = ShardProgress(self.output, name,
+                                          self.shardsettings(source),
+                                          self.resume)
+        try:
+            ndicts = self.writegroups(groups, name)
+            if self.progress is not None and self.progress.resumed:
+                print(f'Resumed {self.progress.resumed} finished html files')
+            print('Writing opf:')
+            with self.metrics.stage('write opf') as stage:
+                if self.volumes > 1:
+                    opf = self.writevolumes(ndicts, name)
+                else:
+                    self.writeopf(ndicts, name)
+                    opf = os.path.join(self.output, f'{name}.opf')
+                stage['records'] = ndicts
+            if self.progress is not None:
+                self.progress.remove()
+        except UnsortedInput:
+            # The html files of the aborted sorted pass are planned from
+            # the wrong order, a resumed fallback must not skip them
+            if self.progress is not None:
+                self.progress.remove()
+            raise
+        finally:
+            if self.progress is not None:
+                self.progress.close()
+            self.progress = None
+            if self.shardcache is not None:
+                self.shardcache.save()
+                print(f'Kept {self.shardcache.kept} unchanged html files')
+                self.shardcache = None
+        return opf
+
+    def shardsettings(self, source):
+        '''
+        Everything that decides how the html files of source are planned
+        and what they contain
+        '''
+        return {'version': VERSION, 'source': source,
+                'module': self.module, 'collation': self.collation,
+                'html': self.html, 'shard_keys': self.shard_keys,
+                'shard_bytes': self.shard_bytes}
+
+    def inputsettings(self, filename):
+        '''
+        Identifies the input of convert: the path, size and mtime of the
+        tab file or the database
+        '''
+        stat = os.stat(filename)
+        return {'file': os.path.abspath(filename), 'size': stat.st_size,
+                'mtime': stat.st_mtime_ns}
+
 
 ######################################################
 # main
 ######################################################
 
 
-defns = readkeys()
-name = os.path.splitext(os.path.basename(FILENAME))[0]
-ndicts = writekeys(defns, name)
-print('Writing opf:')
-writeopf(ndicts, name)
+def main(argv=None):
+    args = parseargs(argv)
+    metrics = Metrics(profile=args.profile is not None)
+    converter = Tab2Opf(output=args.output, module=args.module,
+                        source=args.source, target=args.target,
+                        verbose=args.verbose, key_cache=args.key_cache,
+                        presorted=args.presorted,
+                        memory_budget=args.memory_budget,
+                        jobs=args.jobs, cache_dir=args.cache,
+                        shard_keys=args.shard_keys,
+                        shard_bytes=args.shard_bytes, metrics=metrics,
+                        storage=args.storage, collation=args.collation,
+                        html=args.html, resume=args.resume,
+                        volumes=args.volumes)
+    converter.convert(args.file)
+    metrics.write(args.metrics, args.profile)
+
+
+if __name__ == '__main__':
+    main()
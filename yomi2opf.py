@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Script for converting a yomichan zip archive (or its unzipped folder) straight
+# into an OPF/html dictionary, without the intermediate tab file.
+# It runs the yomi2tab processing and passes the entries to tab2opf in memory.
+#
+# (C) Oleksii Kyrylchuk 2018 (https://github.com/olety)
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+VERSION = '0.1'
+
+import argparse
+import logging
+import os
+from functools import partial
+
+import yomi2tab
+from tab2opf import Tab2Opf, TEMPLATES, SHARD_MINIMUMS, atleast
+from collation import COLLATIONS
+
+
+def iter_records(foldername, simplify, jobs=1, tabfile=None, cache_dir=None):
+    # Yields the (word, def) records of every term bank with real newlines.
+    # If tabfile is set, the records are also written there in the same
+    # format as yomi2tab --stream
+    to_process = yomi2tab.list_term_banks(foldername)
+    process = partial(yomi2tab.process_bank, simplify=simplify,
+                      escape_newlines=False)
+    writer = None
+    if tabfile is not None:
+        writer = yomi2tab.tab_writer(tabfile)
+    dedup = yomi2tab.Deduplicator()
+    for rows in yomi2tab.map_files(process, to_process, jobs, cache_dir):
+        rows = list(dedup.unique(rows))
+        if writer is not None:
+            writer.writerows((word, defn.replace('\n', '\\n'))
+                             for word, defn in rows)
+        yield from rows
+    logging.info(f'Dropped {dedup.dropped} duplicate entries.')
+
+
+def convert_folder(foldername, converter, name=None, simplify=False, jobs=1,
+                   tab=None):
+    # Converts a yomichan folder with a Tab2Opf converter,
+    # returns the path of the written opf.
+    # The processed banks are cached in the cache folder of the converter
+    if name is None:
+        name = os.path.splitext(yomi2tab.infer_output_name(foldername))[0]
+    records = partial(iter_records, foldername, simplify, jobs,
+                      cache_dir=converter.cache_dir)
+    if tab is None:
+        return converter.convertrecords(records(), name)
+    with yomi2tab.open_output(tab) as tabfile:
+        return converter.convertrecords(records(tabfile), name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=f'Yomi2Opf [v{VERSION}] Converts EPWINGS dictionaries from '
+        'yomichan zipped json straight into the OPF/html format that can be '
+        'converted to MOBI with kindlegen. Made by Oleksii Kyrylchuk',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(type=str, metavar='path', dest='folder',
+                        help='Path to the yomichan-import zip archive or to '
+                        'the folder with its unzipped json files.')
+    parser.add_argument('-s', '--simplify', action='store_true',
+                        help='Simplify definitions, same as in yomi2tab.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to process the term '
+                        'banks.')
+    parser.add_argument('-n', '--name', default=None,
+                        help='Basename of the output files. Default '
+                        'behaviour: infers the name.')
+    parser.add_argument('--tab', default=None, metavar='tab_file',
+                        help='Also write the entries to this tab file.')
+    parser.add_argument('-m', '--module',
+                        help='Import module for mapping, getkey, getdef')
+    parser.add_argument('--source', default='ja', help='Source language')
+    parser.add_argument('--target', default='ja', help='Target language')
+    parser.add_argument('-o', '--output', default='opf', help='Target folder')
+    parser.add_argument('--collation', choices=sorted(COLLATIONS),
+                        default='codepoint',
+                        help='Order of the keys. gojuon sorts in dictionary '
+                        'order, with the katakana and hiragana spellings of a '
+                        'word next to each other.')
+    parser.add_argument('--html', choices=sorted(TEMPLATES), default='pretty',
+                        help='pretty indents the html files, compact writes '
+                        'the same markup without the indentation.')
+    parser.add_argument('--shard-keys', default=10000,
+                        type=atleast(SHARD_MINIMUMS['shard_keys']),
+                        help='Maximum number of keys in a single html file')
+    parser.add_argument('--shard-bytes', default=0,
+                        type=atleast(SHARD_MINIMUMS['shard_bytes']),
+                        help='Maximum size of a single html file in bytes, '
+                        '0 for no limit')
+    parser.add_argument('--volumes', type=int, default=1,
+                        help='Split the dictionary into this many volumes by '
+                        'key range, each with its own opf, see opf2mobi.py.')
+    parser.add_argument('--cache', default=None, metavar='cache_dir',
+                        help='Keep the processed term banks and the hashes of '
+                        'the html files in this folder, so that a rebuild '
+                        'only redoes what changed.')
+    parser.add_argument('--metrics', default=None, metavar='metrics_file',
+                        help='Write the wall time, CPU time, peak memory and '
+                        'record count of every stage to this json file.')
+    parser.add_argument('--profile', default=None, metavar='profile_file',
+                        help='Write a cProfile of the slowest stage to this '
+                        'file.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show verbose output.')
+    args = parser.parse_args()
+
+    yomi2tab.setup_logging(args.verbose)
+    yomi2tab.METRICS.profile = args.profile is not None
+
+    # Both halves report their stages into the same metrics
+    converter = Tab2Opf(output=args.output, module=args.module,
+                        source=args.source, target=args.target,
+                        verbose=args.verbose, cache_dir=args.cache,
+                        metrics=yomi2tab.METRICS, collation=args.collation,
+                        html=args.html, volumes=args.volumes,
+                        shard_keys=args.shard_keys,
+                        shard_bytes=args.shard_bytes)
+    opf = convert_folder(args.folder, converter, name=args.name,
+                         simplify=args.simplify, jobs=args.jobs, tab=args.tab)
+    yomi2tab.METRICS.write(args.metrics, args.profile)
+    logging.info(f'Successfully saved the dictionary to {opf}.')
@@ -30,42 +30,57 @@
 VERSION = '0.2b'
 
 import pprint
-import pandas as pd
 import argparse
 import logging
 import json
+import csv
+import hashlib
 import os
+import pickle
+import re
+import posixpath
+import shutil
+import zipfile
 from tqdm import tqdm
 from functools import partial
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from itertools import compress
+from operator import itemgetter
 import sys
+from metrics import Metrics
+from collation import COLLATIONS
+from database import DatabaseWriter
+
+
+# Stage metrics, written out with --metrics/--profile.
+# The per-file stages are only recorded with --jobs 1
+METRICS = Metrics()
 
 
 def clean_brackets(definition_list):
     # Add extra spacing for 【 braces that don't have it
-    return [defn.replace('【', ' 【')
-            if len(defn.split(' 【')) == 1
-            else defn
+    return [defn.replace('【', ' 【') if ' 【' not in defn else defn
             for defn in definition_list]
 
 
-def transform_simplify(definition_list):
-    # Remove '-random_katakana' from definitions
-    new_def = ''
-    for definition in definition_list:
-        defn = definition.split('\n')
-        # Processing the header
-        header = defn[0].split(' ')
-        try:
-            if header[1][0] == '―':
-                header = [header[0]] + header[2:]
-        except:
-            pass
-        defn[0] = ' '.join(header).replace('-', '')
+def simplify_definition(definition):
+    # Remove '-random_katakana' from the header (first line) of a definition:
+    # the second word of the header is dropped if it starts with ―,
+    # then every dash of the header. The definition ends with a newline
+    header, newline, body = definition.partition('\n')
+    first, space, rest = header.partition(' ')
+    if rest.startswith('―'):
+        _, space, rest = rest.partition(' ')
+        header = first + space + rest
+    return ''.join((header.replace('-', ''), newline, body, '\n'))
+
 
-        # Appending the definition
-        new_def += '\n'.join(defn) + '\n'
-    return new_def
+def transform_simplify(definition_list):
+    # Remove '-random_katakana' from definitions and merge them,
+    # see simplify_definition
+    return ''.join([simplify_definition(defn) for defn in definition_list])
 
 
 def clean_word_starts(word):
@@ -104,77 +119,537 @@ def process_katakana_kanji(row):
     return row
 
 
-def process_folder(foldername, simplify):
+KATAKANA_SPAN = re.compile('[\u30a0-\u30ff](?:.*[\u30a0-\u30ff])?', re.DOTALL)
+
+
+def fix_katakana_kanji(word, reading):
+    # Same as process_katakana_kanji for a single word with a ―.
+    # The regex finds the span from the first to the last katakana in one go
+    # Malformed entries are returned unchanged, just like the original
+    kanji = word.split('―')
+    if not isinstance(reading, str):
+        return word
+    match = KATAKANA_SPAN.search(reading)
+    if match is None:
+        return word
+    return kanji[0] + match.group() + kanji[1]
+
+
+def process_katakana_kanji_column(df):
+    # Vectorized version of df.apply(process_katakana_kanji, axis=1)
+    # Only the rows that have a ― in the word are touched
+    mask = df['word'].str.contains('―', regex=False, na=False)
+    if mask.any():
+        df.loc[mask, 'word'] = [
+            fix_katakana_kanji(word, reading)
+            for word, reading in zip(df.loc[mask, 'word'],
+                                     df.loc[mask, 'reading'])]
+    return df
+
+
+class ZipMember(namedtuple('ZipMember', ['archive', 'name'])):
+    # A json file inside the zip archive made by yomichan-import.
+    # It is picklable, so the worker processes open the archive themselves
+    def __str__(self):
+        return f'{self.archive}:{self.name}'
+
+
+def is_term_bank(filename):
+    return filename.endswith('.json') and not filename.startswith('index')
+
+
+def bank_order(filename):
+    # term_bank_2.json comes before term_bank_10.json, names without a number
+    # after the numbered ones, so the order doesn't depend on the filesystem
+    # or on the layout of the archive
+    number = re.search(r'(\d+)\.json$', filename)
+    if number is None:
+        return 1, 0, filename
+    return 0, int(number.group(1)), filename
+
+
+def list_term_banks(foldername):
+    # Every json file except index.json is a term bank, in bank_order.
+    # foldername can also be the zip archive itself, then the banks are
+    # its members and are decompressed while they are read
+    if zipfile.is_zipfile(foldername):
+        with zipfile.ZipFile(foldername) as archive:
+            names = [f for f in archive.namelist()
+                     if is_term_bank(posixpath.basename(f))]
+        names.sort(key=lambda f: bank_order(posixpath.basename(f)))
+        return [ZipMember(foldername, f) for f in names]
+    names = sorted(filter(is_term_bank, os.listdir(foldername)),
+                   key=bank_order)
+    return [os.path.join(foldername, f) for f in names]
+
+
+def index_file(foldername):
+    # index.json of a folder or of a zip archive
+    if zipfile.is_zipfile(foldername):
+        with zipfile.ZipFile(foldername) as archive:
+            for f in archive.namelist():
+                if posixpath.basename(f) == 'index.json':
+                    return ZipMember(foldername, f)
+        raise FileNotFoundError(f'{foldername} has no index.json')
+    return os.path.join(foldername, 'index.json')
+
+
+@contextmanager
+def open_bank(file_path):
+    # Opens a term bank (or index.json) in binary mode,
+    # either a file or a ZipMember
+    if isinstance(file_path, ZipMember):
+        with zipfile.ZipFile(file_path.archive) as archive, \
+                archive.open(file_path.name) as f:
+            yield f
+    else:
+        with open(file_path, 'rb') as f:
+            yield f
+
+
+JSON_DECODER = json.JSONDecoder()
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def read_term_bank(file_path):
+    # Term banks are json arrays of 8-element entries:
+    # [word, reading, tags, rules, score, definitions, id, term_tags]
+    # The array is decoded one entry at a time, so only the raw text of the
+    # current bank and a single entry are in memory at once
+    with open_bank(file_path) as f:
+        text = f.read().decode('utf-8')
+    pos = JSON_SEPARATORS.match(text).end()
+    if not text.startswith('[', pos):
+        raise ValueError(f'{file_path} is not a yomichan term bank')
+    pos += 1
+    while True:
+        pos = JSON_SEPARATORS.match(text, pos).end()
+        if text.startswith(']', pos):
+            return
+        entry, pos = JSON_DECODER.raw_decode(text, pos)
+        yield entry[0], entry[1], entry[5]
+
+
+def join_definitions(definitions, simplify):
+    # Merges the definitions of an entry into one string
+    if simplify:
+        return transform_simplify(definitions)
+    return '\n'.join(definitions)
+
+
+def process_record(word, reading, defn):
+    # Making mixed kanji/kanakana words display properly
+    if '―' in word:
+        word = fix_katakana_kanji(word, reading)
+    return clean_word_starts(word), reading, defn
+
+
+def process_records(records, simplify):
+    # Record-based version of the per-file steps in process_folder.
+    # Takes (word, reading, definitions) and yields (word, reading, def)
+    for word, reading, definitions in records:
+        defn = join_definitions(definitions, simplify)
+        yield process_record(word, reading, defn)
+        # Hiragana-only duplicate, same as df_kanji in process_folder
+        if len(reading) != 0:
+            yield process_record(reading, reading, defn)
+
+
+def row_digest(word, reading, defn):
+    # 128-bit digest of a row, kept instead of the row to find duplicates
+    row = '\0'.join((word, reading, defn)).encode('utf-8')
+    return int.from_bytes(
+        hashlib.blake2b(row, digest_size=16).digest(), 'big')
+
+
+def filter_rows(rows, escape_newlines=True):
+    # Same newline escaping and filtering of empty entries as in
+    # process_folder, for (word, reading, def) rows.
+    # The newlines are kept as they are if escape_newlines is False
+    for word, reading, defn in rows:
+        if escape_newlines:
+            defn = defn.replace('\n', '\\n')
+        if word == '' or defn == '':
+            continue
+        yield word, reading, defn
+
+
+def digest_rows(rows, escape_newlines=True):
+    # filter_rows, then replaces the reading with the digest of the row:
+    # (digest, word, def), the reading is only needed to find duplicates
+    return [(row_digest(word, reading, defn), word, defn)
+            for word, reading, defn in filter_rows(rows, escape_newlines)]
+
+
+def unique_rows(rows):
+    # drop_duplicates for rows that are all kept in memory anyway, like in
+    # process_folder_records. Hashing the tuples is much faster than
+    # digesting them and costs no extra memory, as the strings are shared.
+    # Returns the unique rows in order and the number of dropped rows
+    unique = {}
+    total = 0
+    for total, row in enumerate(rows, start=1):
+        unique.setdefault(row, None)
+    return list(unique), total - len(unique)
+
+
+class Deduplicator:
+    # Same as drop_duplicates on (word, reading, def), but only remembers the
+    # digests of the rows it has seen, so the banks can be passed through it
+    # one at a time and the memory cost is a small int per unique entry
+    def __init__(self):
+        self.seen = set()
+        self.dropped = 0
+
+    def unique(self, rows):
+        # Yields the (word, def) of the (digest, word, def) rows
+        # that weren't seen before, in order
+        seen = self.seen
+        for digest, word, defn in rows:
+            if digest in seen:
+                self.dropped += 1
+                continue
+            seen.add(digest)
+            yield word, defn
+
+
+def process_bank(file_path, simplify, escape_newlines=True):
+    # Processes a single bank for stream_folder and returns its
+    # (digest, word, def) rows, already escaped and filtered.
+    # The duplicates are dropped by a Deduplicator in the main process
+    logging.debug(f'Processing file {file_path}')
+    rows = process_records(read_term_bank(file_path), simplify)
+    return digest_rows(rows, escape_newlines)
+
+
+def process_file_records(file_path, simplify, escape_newlines=True):
+    # Same as process_file, but returns a list of (word, reading, def)
+    # tuples instead of a DataFrame, in the same order. The rows are
+    # already escaped and filtered like in process_folder
+    logging.debug(f'Processing file {file_path}')
+    with METRICS.stage('read json'):
+        entries = list(read_term_bank(file_path))
+        METRICS.count('read json', len(entries))
+    # Hiragana-only words, same as df_kanji in process_file
+    entries += [(reading, reading, definitions)
+                for _, reading, definitions in entries if len(reading) != 0]
+    # Stable, just like sort_values(kind='mergesort')
+    entries.sort(key=itemgetter(1), reverse=True)
+    with METRICS.stage('definitions'):
+        defns = [join_definitions(definitions, simplify)
+                 for _, _, definitions in entries]
+        METRICS.count('definitions', len(defns))
+    with METRICS.stage('katakana fixup'):
+        rows = [process_record(word, reading, defn)
+                for (word, reading, _), defn in zip(entries, defns)]
+        METRICS.count('katakana fixup', len(rows))
+    return list(filter_rows(rows, escape_newlines))
+
+
+def process_folder_records(foldername, simplify, jobs=1, cache_dir=None,
+                           collation='codepoint', escape_newlines=True):
+    # The default engine: process_folder with plain tuples instead of pandas.
+    # Returns the (word, def) rows, in the same order as process_folder
     logging.debug(f'Starting processing the folder {foldername}...')
-    logging.debug('Initializing variables...')
-    result = []
-    to_process = [os.path.join(foldername, f)
-                  for f in os.listdir(foldername)
-                  if f.endswith('.json') and not f.startswith('index')]
+    to_process = list_term_banks(foldername)
     logging.debug('Files to process:')
     logging.debug(pprint.pformat(to_process))
-    logging.debug('Starting the loop...')
-    for file_path in tqdm(to_process, unit='file', desc='Processing files'):
-        # Start and initializing
-        logging.debug(f'Processing file {file_path}')
-
-        logging.debug('Reading the json...')
-        df = pd.read_json(file_path, encoding='utf-8')
-        logging.debug(f'Successfully read the file {file_path}...')
-
-        logging.debug('Selecting the correct columns...')
-        df.columns = ['word', 'reading', 'unknown1', 'unknown2',
-                      'unknown3', 'def', 'id', 'unknown4']
-        df = df[['word', 'reading', 'def']]
-        logging.debug(f'Selected the columns {df.columns.values}...')
-
-        # Hiragana-only words
-        logging.debug('Starting processing the duplicate dataframe')
-        logging.debug('This will allow us to look up words that are '
-                      'spelled with hiragana and not kanji.')
-        df_kanji = df[df['reading'].str.len() != 0]
-        logging.debug('Copying the reading column to the key column')
-        df_kanji.loc[:, 'word'] = df_kanji['reading']
-        logging.debug('Concatenating the two dataframes, one for kanji words,'
-                      'and the second one for hiragana words.')
-        df = pd.concat([df, df_kanji]).sort_values(
-            by='reading', ascending=False).reset_index(drop=True)
-
-        # Transforming the def field + deleting dupes
-        # Merging the definitions
+    with METRICS.stage('process banks'):
+        banks = list(map_files(
+            partial(process_file_records, simplify=simplify,
+                    escape_newlines=escape_newlines),
+            to_process, jobs, cache_dir))
+        METRICS.count('process banks', sum(map(len, banks)))
+
+    logging.debug('Deleting duplicates.')
+    with METRICS.stage('drop duplicates') as stage:
+        rows, stage['dropped'] = unique_rows(
+            row for bank in banks for row in bank)
+        METRICS.count('drop duplicates', len(rows))
+    del banks
+    logging.info(f'Dropped {stage["dropped"]} duplicate entries.')
+
+    with METRICS.stage('sort'):
+        sortkey = COLLATIONS[collation]
+        if sortkey is None:
+            rows.sort(key=itemgetter(0))
+        else:
+            rows.sort(key=lambda row: sortkey(row[0]))
+    return [(word, defn) for word, _, defn in rows]
+
+
+def stream_folder(foldername, simplify, output_file, jobs=1, cache_dir=None,
+                  output_format='tab'):
+    # Streaming version of process_folder + to_csv. Every bank is processed
+    # and written before the next one is read, so the memory usage is bounded
+    # by the largest bank and not by the whole dictionary.
+    # The entries are written in bank order (tab2opf sorts the keys anyway).
+    # The duplicates are dropped across all banks with a Deduplicator.
+    logging.debug(f'Starting streaming the folder {foldername}...')
+    to_process = list_term_banks(foldername)
+    logging.debug('Files to process:')
+    logging.debug(pprint.pformat(to_process))
+    written = 0
+    dedup = Deduplicator()
+    process = partial(process_bank, simplify=simplify,
+                      escape_newlines=output_format == 'tab')
+    with METRICS.stage('stream banks') as stage, \
+            open_writer(output_file, output_format) as writer:
+        for rows in map_files(process, to_process, jobs, cache_dir):
+            rows = list(dedup.unique(rows))
+            writer.writerows(rows)
+            written += len(rows)
+        METRICS.count('stream banks', written)
+        stage['dropped'] = dedup.dropped
+    logging.info(f'Dropped {dedup.dropped} duplicate entries.')
+    return written
+
+
+def tab_writer(f):
+    # Same format as result.to_csv in the main function
+    return csv.writer(f, delimiter='\t', lineterminator='\n')
+
+
+def set_pandas_options():
+    # Setting pandas options so it won't throw warnings for no reason
+    import pandas as pd
+    pd.set_option('mode.chained_assignment', None)
+    pd.set_option('max_colwidth', 100)  # for debug
+
+
+def map_files(function, to_process, jobs=1, cache_dir=None, initializer=None):
+    # Runs function on every term bank, in a process pool if jobs > 1.
+    # The results always come back in the order of to_process, so the output
+    # doesn't depend on the number of jobs.
+    # If cache_dir is set, the results of unchanged banks come from the cache.
+    # initializer is run in every worker process
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        function = BankCache(function, cache_dir)
+    progress = partial(tqdm, total=len(to_process), unit='file',
+                       desc='Processing files')
+    if jobs <= 1:
+        yield from progress(map(function, to_process))
+        return
+    logging.debug(f'Processing the files with {jobs} processes.')
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=initializer) as executor:
+        yield from progress(executor.map(function, to_process))
+
+
+def transform_settings(function):
+    # Everything that changes the result of a per-file function: its name,
+    # its arguments (e.g. simplify) and the code of this script
+    with open(__file__, 'rb') as f:
+        code = hashlib.sha256(f.read()).hexdigest()
+    arguments = sorted(getattr(function, 'keywords', {}).items())
+    function = getattr(function, 'func', function)
+    return json.dumps({'function': function.__name__,
+                       'arguments': arguments,
+                       'version': VERSION, 'code': code})
+
+
+class BankCache:
+    # Wraps a per-file function of map_files and keeps its results in
+    # cache_dir under the hash of the term bank contents and the settings.
+    # Unchanged banks are loaded from the cache instead of being processed
+    def __init__(self, function, cache_dir):
+        self.function = function
+        self.cache_dir = cache_dir
+        self.settings = transform_settings(function)
+
+    def digest(self, file_path):
+        content = hashlib.sha256(self.settings.encode('utf-8'))
+        with open_bank(file_path) as f:
+            for block in iter(partial(f.read, 1 << 20), b''):
+                content.update(block)
+        return content.hexdigest()
+
+    def __call__(self, file_path):
+        cache_path = os.path.join(self.cache_dir,
+                                  f'{self.digest(file_path)}.pickle')
+        try:
+            with open(cache_path, 'rb') as f:
+                result = pickle.load(f)
+            logging.debug(f'{file_path} is unchanged, using {cache_path}')
+            return result
+        except Exception:
+            # Missing or unreadable (e.g. written by another pandas version)
+            pass
+        result = self.function(file_path)
+        # Writing to a temporary file first, so that a killed run
+        # can't leave a broken cache entry behind
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        return result
+
+
+def open_output(output_file):
+    # argparse gives us an open file, the inferred name is a string
+    if isinstance(output_file, str):
+        return open(output_file, 'w', encoding='utf-8', newline='')
+    return output_file
+
+
+@contextmanager
+def open_writer(output_file, output_format='tab'):
+    # Yields something with writerows for the (word, def) rows:
+    # a csv writer for a tab file, a DatabaseWriter for sqlite.
+    # The sqlite rows should keep their newlines, see database.py
+    if output_format == 'sqlite':
+        if not isinstance(output_file, str):
+            output_file.close()
+            output_file = output_file.name
+        with DatabaseWriter(output_file) as writer:
+            yield writer
+    else:
+        with open_output(output_file) as f:
+            yield tab_writer(f)
+
+
+def checkpoint_dir(output_file):
+    # Folder with the processed banks of a --resume run, next to the output
+    if not isinstance(output_file, str):
+        output_file = output_file.name
+    return f'{output_file}.checkpoint'
+
+
+def infer_output_name(foldername, extension='.tab'):
+    logging.debug('Trying to infer the dictionary name...')
+    try:
+        with open_bank(index_file(foldername)) as f:
+            index_json = json.load(f)
+            output_file = f'{index_json["title"]}{extension}'
+    except:
+        output_file = f'EPWING{extension}'
+    logging.debug(f'Obtained file name is {output_file}.')
+    return output_file
+
+
+def setup_logging(verbose):
+    # Setting up logging
+    LOGGING_FMT = '%(levelname)s | %(asctime)s | line %(lineno)s | %(funcName)s | %(message)s'
+    LOGGING_DATEFMT = '%H:%M:%S'
+
+    logging_conf = partial(logging.basicConfig, format=LOGGING_FMT,
+                           datefmt=LOGGING_DATEFMT, stream=sys.stdout)
+
+    if verbose:
+        logging_conf(level=logging.DEBUG)
+    else:
+        logging_conf(level=logging.INFO)
+
+
+def process_file(file_path, simplify):
+    # pandas is only needed for --engine pandas
+    import pandas as pd
+
+    # Start and initializing
+    logging.debug(f'Processing file {file_path}')
+
+    logging.debug('Reading the json...')
+    with METRICS.stage('read json'), open_bank(file_path) as f:
+        df = pd.read_json(f, encoding='utf-8')
+        METRICS.count('read json', len(df))
+    logging.debug(f'Successfully read the file {file_path}...')
+
+    logging.debug('Selecting the correct columns...')
+    df.columns = ['word', 'reading', 'unknown1', 'unknown2',
+                  'unknown3', 'def', 'id', 'unknown4']
+    df = df[['word', 'reading', 'def']]
+    logging.debug(f'Selected the columns {df.columns.values}...')
+
+    # Hiragana-only words
+    logging.debug('Starting processing the duplicate dataframe')
+    logging.debug('This will allow us to look up words that are '
+                  'spelled with hiragana and not kanji.')
+    df_kanji = df[df['reading'].str.len() != 0]
+    logging.debug('Copying the reading column to the key column')
+    df_kanji.loc[:, 'word'] = df_kanji['reading']
+    logging.debug('Concatenating the two dataframes, one for kanji words,'
+                  'and the second one for hiragana words.')
+    # A stable sort, so the order doesn't depend on the pandas version
+    df = pd.concat([df, df_kanji]).sort_values(
+        by='reading', ascending=False, kind='mergesort').reset_index(drop=True)
+
+    # Transforming the def field + deleting dupes
+    # Merging the definitions
+    with METRICS.stage('definitions'):
         if simplify:
             logging.debug('Simplifying the definitions.')
-            df['def'] = df['def'].apply(transform_simplify)
+            df['def'] = [transform_simplify(defs) for defs in df['def']]
         else:
             logging.debug('Transforming the definition into one string.')
             df['def'] = df['def'].apply(lambda x: '\n'.join(x))
-        # Making mixed kanji/kanakana words display properly
-        df = df.apply(process_katakana_kanji, axis=1)
+        METRICS.count('definitions', len(df))
+    # Making mixed kanji/kanakana words display properly
+    with METRICS.stage('katakana fixup'):
+        df = process_katakana_kanji_column(df)
         df['word'] = df['word'].apply(clean_word_starts)
+        METRICS.count('katakana fixup', len(df))
+    return df
+
 
-        logging.debug('Appending the dataframe to the result array.')
-        result.append(df)
+def process_folder(foldername, simplify, jobs=1, cache_dir=None,
+                   collation='codepoint', escape_newlines=True):
+    # The pandas engine, returns a DataFrame with word and def columns.
+    # collation is the order of the words, see collation.py
+    import pandas as pd
+
+    logging.debug(f'Starting processing the folder {foldername}...')
+    logging.debug('Initializing variables...')
+    to_process = list_term_banks(foldername)
+    logging.debug('Files to process:')
+    logging.debug(pprint.pformat(to_process))
+    logging.debug('Starting the loop...')
+    # Every file is processed on its own, only the steps below need
+    # the whole dictionary
+    with METRICS.stage('process banks'):
+        result = list(map_files(partial(process_file, simplify=simplify),
+                                to_process, jobs, cache_dir,
+                                initializer=set_pandas_options))
+        METRICS.count('process banks', sum(len(df) for df in result))
 
     # Concatenating the result and returning it
     logging.debug('Concatenating the result array.')
-    result = pd.concat(result)
+    with METRICS.stage('concatenate'):
+        result = pd.concat(result)
 
     # Some extra changes due to how tab2opf treats newlines
     logging.debug('Changing the newlines from \\n -> \\\\n '
                   'so tab2opf can read them.')
-    result['def'] = result['def'].str.replace('\n', '\\n')
+    if escape_newlines:
+        with METRICS.stage('escape newlines'):
+            result['def'] = result['def'].str.replace('\n', '\\n')
 
     # Dropping empty strings
     logging.debug('Deleting entries with empty headwords.')
-    result.replace('', pd.np.nan, inplace=True)
-    result.dropna(subset=['word', 'def'], inplace=True)
+    with METRICS.stage('drop empty'):
+        result.replace('', float('nan'), inplace=True)
+        result.dropna(subset=['word', 'def'], inplace=True)
+        METRICS.count('drop empty', len(result))
 
     # Deleting dupes
     logging.debug('Deleting duplicates.')
-    result.drop_duplicates(inplace=True)
-
-    # Maybe use a special sort for japanese characters?
-    result = result.sort_values(by='word').reset_index()
+    with METRICS.stage('drop duplicates') as stage:
+        before = len(result)
+        result.drop_duplicates(inplace=True)
+        METRICS.count('drop duplicates', len(result))
+        stage['dropped'] = before - len(result)
+    logging.info(f'Dropped {stage["dropped"]} duplicate entries.')
+
+    # Sorting in code point order, or in dictionary order with --collation
+    with METRICS.stage('sort'):
+        sortkey = COLLATIONS[collation]
+        if sortkey is None:
+            result = result.sort_values(by='word', kind='mergesort')
+        else:
+            # The key argument needs pandas 1.1
+            result = result.sort_values(by='word', kind='mergesort',
+                                        key=lambda words: words.map(sortkey))
+        result = result.reset_index()
     logging.debug('Returning the result dataframe.')
     return result
 
@@ -189,8 +664,8 @@ if __name__ == '__main__':
 
     # Source files
     parser.add_argument(type=str, metavar='path', dest='folder',
-                        help='Path to the unzipped yomichan-import '
-                        'archive folder with json files.')
+                        help='Path to the yomichan-import zip archive or to '
+                        'the folder with its unzipped json files.')
     # Simplify defs
     parser.add_argument('-s', '--simplify', action='store_true',
                         help='Simplify definitions. This gets rid of the extra '
@@ -201,49 +676,126 @@ if __name__ == '__main__':
                         nargs='?', help='Output file path. Default behaviour: '
                         'infers the name.', metavar='output_file', default=None)
 
+    # Streaming
+    parser.add_argument('--stream', action='store_true',
+                        help='Process and write one term bank at a time '
+                        'instead of loading the whole dictionary into memory. '
+                        'Entries are written in bank order instead of being '
+                        'sorted.')
+
+    # Output format
+    parser.add_argument('--format', choices=['tab', 'sqlite'], default='tab',
+                        dest='output_format',
+                        help='tab writes a tab file, sqlite an SQLite database '
+                        'that tab2opf reads without any escaping and with a '
+                        'key index.')
+
+    # Engine
+    parser.add_argument('--engine', choices=['records', 'pandas'],
+                        default='records',
+                        help='records processes the entries as plain tuples, '
+                        'pandas uses DataFrames and needs pandas installed. '
+                        'Both give the same output.')
+
+    # Collation
+    parser.add_argument('--collation', choices=sorted(COLLATIONS),
+                        default='codepoint',
+                        help='Order of the entries. gojuon sorts in dictionary '
+                        'order, with the katakana and hiragana spellings of a '
+                        'word next to each other. Use the same collation for '
+                        'tab2opf.')
+
+    # Parallelism
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to process the term '
+                        'banks. The output is the same for any number of jobs.')
+
+    # Incremental rebuilds
+    parser.add_argument('--cache', default=None, metavar='cache_dir',
+                        help='Keep the processed term banks in this folder, '
+                        'so that a rebuild only processes the banks that '
+                        'changed since the last run.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep every processed term bank in '
+                        'output_file.checkpoint until the output is written, '
+                        'so that a killed run picks up where it stopped '
+                        'when it is started again with --resume. Uses the '
+                        '--cache folder instead if it is set.')
+
+    # Instrumentation
+    parser.add_argument('--metrics', default=None, metavar='metrics_file',
+                        help='Write the wall time, CPU time, peak memory and '
+                        'record count of every stage to this json file.')
+    parser.add_argument('--profile', default=None, metavar='profile_file',
+                        help='Write a cProfile of the slowest stage to this '
+                        'file.')
+
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Show verbose output.')
     # Parse the args
     args = parser.parse_args()
 
-    # Setting up logging
-    LOGGING_FMT = '%(levelname)s | %(asctime)s | line %(lineno)s | %(funcName)s | %(message)s'
-    LOGGING_DATEFMT = '%H:%M:%S'
+    setup_logging(args.verbose)
+    METRICS.profile = args.profile is not None
 
-    logging_conf = partial(logging.basicConfig, format=LOGGING_FMT,
-                           datefmt=LOGGING_DATEFMT, stream=sys.stdout)
+    if args.engine == 'pandas':
+        logging.debug('Setting pandas options...')
+        set_pandas_options()
+        logging.debug('Finished setting pandas options.')
 
-    if args.verbose:
-        logging_conf(level=logging.DEBUG)
-    else:
-        logging_conf(level=logging.INFO)
-
-    # Setting pandas options so it won't throw warnings for no reason
-    logging.debug('Setting pandas options...')
-    pd.set_option('mode.chained_assignment', None)
-    pd.set_option('max_colwidth', 100)  # for debug
-    logging.debug('Finished setting pandas options.')
+    # Inferring output fname if not set
+    output_file = args.output
+    if not output_file:
+        output_file = infer_output_name(
+            args.folder, '.sqlite' if args.output_format == 'sqlite' else '.tab')
+    escape_newlines = args.output_format == 'tab'
+
+    # The processed banks are checkpointed through the bank cache
+    cache_dir, checkpoint = args.cache, None
+    if args.resume and cache_dir is None:
+        checkpoint = cache_dir = checkpoint_dir(output_file)
+        if os.path.isdir(checkpoint):
+            logging.info(f'Resuming from {checkpoint}...')
+
+    if args.stream:
+        logging.info(f'Streaming the results to {output_file}...')
+        written = stream_folder(args.folder, args.simplify, output_file,
+                                args.jobs, cache_dir, args.output_format)
+        if checkpoint is not None:
+            shutil.rmtree(checkpoint)
+        METRICS.write(args.metrics, args.profile)
+        logging.info(f'Successfully saved {written} entries to {output_file}, '
+                     'quitting the program.')
+        sys.exit(0)
 
     # Processing
     logging.debug('Starting processing the source data...')
-    result = process_folder(args.folder, simplify=args.simplify)
+    if args.engine == 'pandas':
+        result = process_folder(args.folder, simplify=args.simplify,
+                                jobs=args.jobs, cache_dir=cache_dir,
+                                collation=args.collation,
+                                escape_newlines=escape_newlines)
+    else:
+        result = process_folder_records(args.folder, simplify=args.simplify,
+                                        jobs=args.jobs, cache_dir=cache_dir,
+                                        collation=args.collation,
+                                        escape_newlines=escape_newlines)
     logging.debug('Finished processing the source data...')
 
-    # Inferring output fname if not set
-    output_file = args.output
-    if not output_file:
-        logging.debug('Trying to infer the dictionary name...')
-        try:
-            with open(os.path.join(args.folder, 'index.json'), encoding='utf-8') as f:
-                index_json = json.load(f)
-                output_file = f'{index_json["title"]}.tab'
-        except:
-            output_file = 'EPWING.tab'
-        logging.debug(f'Obtained file name is {output_file}.')
-
     # Saving the results
     logging.info(f'Saving the results to {output_file}...')
-    result.to_csv(output_file, header=False, index=False, sep='\t',
-                  encoding='utf-8', columns=['word', 'def'])
+    with METRICS.stage('write output'):
+        if args.engine == 'pandas' and args.output_format == 'tab':
+            result.to_csv(output_file, header=False, index=False, sep='\t',
+                          encoding='utf-8', columns=['word', 'def'])
+        else:
+            if args.engine == 'pandas':
+                result = list(zip(result['word'], result['def']))
+            with open_writer(output_file, args.output_format) as writer:
+                writer.writerows(result)
+        METRICS.count('write output', len(result))
+    if checkpoint is not None:
+        shutil.rmtree(checkpoint)
+    METRICS.write(args.metrics, args.profile)
     logging.info(f'Successfully saved the results to {output_file}, '
                  'quitting the program.')